@@ -2,7 +2,9 @@
 
 import logging
 
-from . import bolt, config, follow, gnip, search, shelf, spout, twitter
+from . import (
+    bolt, config, follow, gnip, ratelimit, search, shelf, spout, terms,
+    twitter)
 from .version import VERSION, __version__
 from .version import __doc__ as __license__
 
@@ -15,9 +17,11 @@ __all__ = [
     'config',
     'follow',
     'gnip',
+    'ratelimit',
     'search',
     'shelf',
     'spout',
+    'terms',
     'twitter',
 ]
 
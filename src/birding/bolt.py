@@ -5,12 +5,14 @@ from __future__ import print_function
 import functools
 import json
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
 from streamparse.bolt import Bolt
 
 from .config import get_config, import_name
 from .search import search_manager_from_config
-from .shelf import shelf_from_config
+from .shelf import get_feedback_shelf, shelf_from_config
 
 
 def fault_barrier(fn):
@@ -27,22 +29,110 @@ def fault_barrier(fn):
     return process
 
 
+def component_tasks(context):
+    """Get number of tasks of the component, given its Storm `context`.
+
+    >>> component_tasks({
+    ...     'taskid': 3,
+    ...     'task->component': {'2': 'search-bolt', '3': 'search-bolt',
+    ...                         '4': 'lookup-bolt'}})
+    2
+    >>>
+    """
+    tasks = context.get('task->component') or {}
+    component = tasks.get(str(context.get('taskid')))
+    return max(1, sum(1 for name in tasks.values() if name == component))
+
+
 def get_search_manager(config=None, **default_init):
     if config is None:
         config = get_config()['SearchManager']
     return search_manager_from_config(config, **default_init)
 
 
-class TwitterSearchBolt(Bolt):
+def manager_stats_json(manager):
+    """Get JSON of rate limit and latency stats of search `manager`."""
+    return json.dumps(
+        {
+            'rate_limit': manager.rate_limit_stats(),
+            'latency': manager.latency_stats(),
+        },
+        sort_keys=True)
+
+
+class ShelfMethods(object):
+    """Mixin for bolts which track values on a shelf."""
+
+    def prepare_shelf(self, config, **default_init):
+        """Get shelf from bolt config, and prepare to log its stats.
+
+        Latencies of shelf operations are only timed when stats are logged.
+        """
+        self.shelf_stats_interval = config.get('shelf_stats_interval')
+        self.shelf_stats_time = time.time()
+        shelf = shelf_from_config(config, **default_init)
+        if self.shelf_stats_interval is not None:
+            shelf.set_timed()
+        return shelf
+
+    def maintain_shelf(self, shelf, manager=None):
+        """Maintain shelf, and log its stats every `shelf_stats_interval`.
+
+        Stats of search `manager`, if given, are logged along with them.
+        """
+        shelf.maintain()
+        if self.shelf_stats_interval is None:
+            return
+        now = time.time()
+        if now - self.shelf_stats_time >= self.shelf_stats_interval:
+            self.shelf_stats_time = now
+            self.log(
+                'shelf stats: {}'
+                .format(json.dumps(shelf.stats_snapshot(), sort_keys=True)))
+            if manager is not None:
+                self.log(
+                    'search manager stats: {}'
+                    .format(manager_stats_json(manager)))
+
+
+class TwitterSearchBolt(ShelfMethods, Bolt):
     def initialize(self, conf, ctx):
         """Initialization steps:
 
-        1. Get :func:`~birding.search.search_manager_from_config`.
+        1. Get :func:`~birding.search.search_manager_from_config`, pacing
+           each task at its share of rate limits.
         2. Prepare to track searched terms as to avoid redundant searches.
+        3. Prepare to batch terms into coalesced searches, if configured.
+        4. Prepare to run searches concurrently, if configured.
+        5. Prepare to feed back search results to the spout, if it uses
+           feedback, see :func:`~birding.shelf.get_feedback_shelf`.
+
+        Feedback needs a search manager which lists statuses of search
+        results, see :attr:`~birding.search.SearchManager.has_statuses`.
+        Stats of the search manager are logged along with those of the term
+        shelf, every ``shelf_stats_interval`` seconds.
         """
         self.manager = get_search_manager()
+        self.manager.set_rate_limit_share(component_tasks(ctx))
         config = get_config()['TwitterSearchBolt']
-        self.term_shelf = shelf_from_config(config)
+        self.term_shelf = self.prepare_shelf(config)
+        self.feedback_shelf = get_feedback_shelf(get_config())
+        if self.feedback_shelf is not None and not self.manager.has_statuses:
+            raise ValueError(
+                'TwitterSearchBolt feedback requires a search manager '
+                'which lists statuses of search results.')
+        self.batch_size = config['batch_size']
+        self.batch_age = config['batch_age']
+        self.batch = []
+        self.batch_time = None
+        self.concurrency = config['concurrency']
+        self.pool = None
+        self.in_flight = []
+        if self.concurrency is not None:
+            self.pool = ThreadPool(self.concurrency)
+        if self.batch_size is not None or self.concurrency is not None:
+            # Tuples are acked once their search completes.
+            self.auto_ack = False
 
     @fault_barrier
     def process(self, tup):
@@ -51,24 +141,186 @@ class TwitterSearchBolt(Bolt):
         1. Stream in (term, timestamp).
         2. Perform :meth:`~birding.search.SearchManager.search` on term.
         3. Emit (term, timestamp, search_result).
+
+        With a configured ``batch_size``, terms are instead batched across
+        tuples and searched together once the batch has ``batch_size`` terms
+        or is ``batch_age`` seconds old, see :meth:`search_batch`.
+
+        With a configured ``concurrency``, up to that many searches (or
+        batches) run at once in a thread pool, see :meth:`submit`.
         """
         term, timestamp = tup.values
-        if term not in self.term_shelf:
-            self.log(
-                'search: {term}, {timestamp}'
-                .format(term=term, timestamp=timestamp))
-            search_result = self.manager.search(q=term)
-            self.emit([term, timestamp, search_result])
+        self.maintain_shelf(self.term_shelf, self.manager)
+        self.emit_completed()
+        if self.batch_size is not None:
+            self.add_to_batch(tup)
+            return
+        if term in self.term_shelf or term in self.in_flight_terms():
+            if not self.auto_ack:
+                self.ack(tup)
+            return
+        self.log(
+            'search: {term}, {timestamp}'
+            .format(term=term, timestamp=timestamp))
+        if self.pool is not None:
+            self.submit([tup], self.search_term, term)
+            return
+        search_result = self.manager.search(q=term)
+        self.emit([term, timestamp, search_result])
+        self.term_shelf[term] = timestamp
+        self.feed_back(term, search_result)
+
+    @fault_barrier
+    def process_tick(self, tup):
+        """Emit completed searches, search old batch, and maintain shelf."""
+        self.maintain_shelf(self.term_shelf, self.manager)
+        self.emit_completed()
+        if self.batch and time.time() - self.batch_time >= self.batch_age:
+            self.search_batch()
+
+    def add_to_batch(self, tup):
+        term, _ = tup.values
+        if (term in self.term_shelf or
+                term in self.batch_terms() or
+                term in self.in_flight_terms()):
+            # Searched recently, or will be with this batch.
+            self.ack(tup)
+            return
+        if not self.batch:
+            self.batch_time = time.time()
+        self.batch.append(tup)
+        if len(self.batch) >= self.batch_size:
+            self.search_batch()
+        elif time.time() - self.batch_time >= self.batch_age:
+            self.search_batch()
+
+    def batch_terms(self):
+        return [tup.values[0] for tup in self.batch]
+
+    def in_flight_terms(self):
+        return [
+            tup.values[0] for tups, _ in self.in_flight for tup in tups]
+
+    def search_term(self, term):
+        """Search for one term, as a dict of term to search result."""
+        return {term: self.manager.search(q=term)}
+
+    def search_batch(self):
+        """Search all terms in batch, then emit & ack each tuple.
+
+        Terms are searched with
+        :meth:`~birding.search.SearchManager.search_many`, which coalesces
+        terms into as few searches as it can. Each term's result is emitted
+        as (term, timestamp, search_result) anchored to that term's tuple. If
+        the search fails, all tuples in the batch fail.
+        """
+        batch, self.batch = self.batch, []
+        terms = [tup.values[0] for tup in batch]
+        self.log('search: batch of {} terms'.format(len(terms)))
+        self.submit(batch, self.manager.search_many, terms)
+
+    def submit(self, tups, search, *args):
+        """Search with ``search(*args)`` for `tups`, see :meth:`emit_results`.
+
+        With a thread pool, the search runs in the pool and its results are
+        emitted once complete, on a later tuple or tick. When ``concurrency``
+        searches are already in flight, wait for the oldest to complete.
+        """
+        if self.pool is None:
+            self.emit_results(tups, search, *args)
+            return
+        while len(self.in_flight) >= self.concurrency:
+            tups_done, result = self.in_flight.pop(0)
+            self.emit_results(tups_done, result.get)
+        self.in_flight.append((tups, self.pool.apply_async(search, args)))
+
+    def emit_completed(self):
+        """Emit results of searches in flight which have completed."""
+        in_flight, self.in_flight = self.in_flight, []
+        for tups, result in in_flight:
+            if result.ready():
+                self.emit_results(tups, result.get)
+            else:
+                self.in_flight.append((tups, result))
+
+    def emit_results(self, tups, search, *args):
+        """Emit & ack each of `tups` with its term's result of a search.
+
+        ``search(*args)`` gives a dict of term to search result, and each
+        term's result is emitted as (term, timestamp, search_result) anchored
+        to that term's tuple. If the search fails, all tuples fail.
+        """
+        try:
+            search_results = search(*args)
+        except Exception as e:
+            print(str(e), file=sys.stderr)
+            for tup in tups:
+                self.fail(tup)
+            return
+        for tup in tups:
+            term, timestamp = tup.values
+            self.emit([term, timestamp, search_results[term]], anchors=[tup])
             self.term_shelf[term] = timestamp
+            self.feed_back(term, search_results[term])
+            self.ack(tup)
+
+    def feed_back(self, term, search_result):
+        """Record number of new statuses for term on feedback shelf, if any.
+
+        Statuses are new when more recent than the most recent status of the
+        term's previous search.
+        """
+        if self.feedback_shelf is None:
+            return
+        feedback = self.feedback_shelf.get(term) or {}
+        newest = feedback.get('newest')
+        status_times = [
+            self.manager.status_time(status)
+            for status in self.manager.search_result_statuses(search_result)]
+        new_times = [t for t in status_times if newest is None or t > newest]
+        if new_times:
+            newest = max(new_times)
+        self.feedback_shelf[term] = {
+            'count': len(new_times),
+            'newest': newest,
+            'time': time.time(),
+        }
 
 
 class TwitterLookupBolt(Bolt):
     def initialize(self, conf, ctx):
         """Initialization steps:
 
-        1. Get :func:`~birding.search.search_manager_from_config`.
+        1. Get :func:`~birding.search.search_manager_from_config`, pacing
+           each task at its share of rate limits.
+        2. Prepare to batch lookups across tuples, if configured.
+        3. Prepare to log stats of the search manager, if configured.
+
+        Batches need a search manager which looks up statuses by ID, given
+        IDs of search results, see
+        :attr:`~birding.search.SearchManager.has_lookup` and
+        :attr:`~birding.search.SearchManager.has_statuses`. To not look up
+        statuses again which were recently looked up for other terms,
+        configure a status shelf on the search manager, see
+        :class:`~birding.twitter.TwitterSearchManager`.
         """
         self.manager = get_search_manager()
+        self.manager.set_rate_limit_share(component_tasks(ctx))
+        config = get_config()['TwitterLookupBolt']
+        has_batch = self.manager.has_lookup and self.manager.has_statuses
+        if config['batch_size'] is not None and not has_batch:
+            raise ValueError(
+                'TwitterLookupBolt batch_size requires a search manager '
+                'with lookup by ID.')
+        self.batch_size = config['batch_size']
+        self.batch_age = config['batch_age']
+        self.batch = []
+        self.batch_time = None
+        self.manager_stats_interval = config['manager_stats_interval']
+        self.manager_stats_time = time.time()
+        if self.batch_size is not None:
+            # Tuples are acked once their batch is looked up.
+            self.auto_ack = False
 
     @fault_barrier
     def process(self, tup):
@@ -77,14 +329,81 @@ class TwitterLookupBolt(Bolt):
         1. Stream in (term, timestamp, search_result).
         2. Perform :meth:`~birding.search.SearchManager.lookup_search_result`.
         3. Emit (term, timestamp, lookup_result).
+
+        With a configured ``batch_size``, status IDs of search results are
+        instead batched across tuples and looked up together once the batch
+        has ``batch_size`` IDs or is ``batch_age`` seconds old, see
+        :meth:`lookup_batch`.
         """
         term, timestamp, search_result = tup.values
+        self.log_manager_stats()
+        if self.batch_size is not None:
+            self.add_to_batch(tup)
+            return
         self.log(
             'lookup: {term}, {timestamp}'
             .format(term=term, timestamp=timestamp))
         lookup_result = self.manager.lookup_search_result(search_result)
         self.emit([term, timestamp, lookup_result])
 
+    @fault_barrier
+    def process_tick(self, tup):
+        """Lookup current batch if it is old enough, and log stats."""
+        self.log_manager_stats()
+        if self.batch and time.time() - self.batch_time >= self.batch_age:
+            self.lookup_batch()
+
+    def log_manager_stats(self):
+        """Log stats of search manager every `manager_stats_interval`."""
+        if self.manager_stats_interval is None:
+            return
+        now = time.time()
+        if now - self.manager_stats_time >= self.manager_stats_interval:
+            self.manager_stats_time = now
+            self.log(
+                'search manager stats: {}'
+                .format(manager_stats_json(self.manager)))
+
+    def add_to_batch(self, tup):
+        term, timestamp, search_result = tup.values
+        id_list = self.manager.search_result_ids(search_result)
+        if not self.batch:
+            self.batch_time = time.time()
+        self.batch.append((tup, id_list))
+        batch_ids = sum(len(batch_id_list) for _, batch_id_list in self.batch)
+        if batch_ids >= self.batch_size:
+            self.lookup_batch()
+        elif time.time() - self.batch_time >= self.batch_age:
+            self.lookup_batch()
+
+    def lookup_batch(self):
+        """Lookup all status IDs in batch, then emit & ack each tuple.
+
+        Each tuple's statuses are emitted as (term, timestamp, lookup_result)
+        anchored to that tuple. If the lookup fails, all tuples in the batch
+        fail.
+        """
+        batch, self.batch = self.batch, []
+        id_set = set()
+        for _, id_list in batch:
+            id_set.update(id_list)
+        self.log('lookup: batch of {} statuses'.format(len(id_set)))
+        try:
+            statuses = dict(
+                (status['id_str'], status)
+                for status in self.manager.lookup(sorted(id_set)))
+        except Exception as e:
+            print(str(e), file=sys.stderr)
+            for tup, _ in batch:
+                self.fail(tup)
+            return
+        for tup, id_list in batch:
+            term, timestamp, _ = tup.values
+            lookup_result = [
+                statuses[_id] for _id in id_list if _id in statuses]
+            self.emit([term, timestamp, lookup_result], anchors=[tup])
+            self.ack(tup)
+
 
 class ElasticsearchIndexBolt(Bolt):
     def initialize(self, conf, ctx):
@@ -116,7 +435,7 @@ class ElasticsearchIndexBolt(Bolt):
             yield status
 
 
-class ResultTopicBolt(Bolt):
+class ResultTopicBolt(ShelfMethods, Bolt):
     def initialize(self, conf, ctx):
         """Initialization steps:
 
@@ -131,7 +450,7 @@ class ResultTopicBolt(Bolt):
         self.producer = self.topic.get_producer()
 
         # Use own default index value while still allowing user config.
-        self.tweet_shelf = shelf_from_config(config, index='pre_kafka_shelf')
+        self.tweet_shelf = self.prepare_shelf(config, index='pre_kafka_shelf')
 
     @fault_barrier
     def process(self, tup):
@@ -139,17 +458,33 @@ class ResultTopicBolt(Bolt):
 
         1. Stream third positional value from input into Kafka topic.
         """
+        self.maintain_shelf(self.tweet_shelf)
         status_seq = self.iter_using_shelf(tup.values[2], self.tweet_shelf)
         # This could be more efficient by passing the result from twitter
         # straight through to the producer, instead of deserializing and
         # reserializing json.
         self.producer.produce(json.dumps(status) for status in status_seq)
 
+    @fault_barrier
+    def process_tick(self, tup):
+        """Maintain tweet shelf, e.g. to flush buffered writes while idle."""
+        self.maintain_shelf(self.tweet_shelf)
+
     @staticmethod
     def iter_using_shelf(statuses, shelf):
+        """Yield statuses not already on shelf, then shelve the yielded IDs.
+
+        Shelf membership is checked and written in one batch for all of the
+        given statuses, instead of once per status.
+        """
+        statuses = list(statuses)
+        seen = set(shelf.get_many(str(status['id']) for status in statuses))
+        yielded = []
         for status in statuses:
             id_str = str(status['id'])
-            if id_str in shelf:
+            if id_str in seen:
                 continue
+            seen.add(id_str)
             yield status
-            shelf[id_str] = None
+            yielded.append(id_str)
+        shelf.set_many((id_str, None) for id_str in yielded)
@@ -34,6 +34,18 @@ Defaults::
       - real-time analytics
       - apache storm
       - pypi
+      skip_fresh: false # skip terms still fresh on TwitterSearchBolt shelf
+      term_source_class: null # e.g. TermFile, to change terms while running
+      term_source_init: {}
+    AdaptiveTermSpout: # polls TermCycleSpout terms, when Spout is this spout
+      min_interval: 30 # seconds between polls of a term, at least
+      max_interval: 900 # seconds between polls of a term, at most
+      target_count: 20 # new statuses to have for a term when polling it
+      smoothing: 0.3 # weight of each search in moving average of velocity
+      shelf_class: SQLiteShelf # feedback from TwitterSearchBolt, shared
+      shelf_init: # local file, so one host only; share a shelf on a cluster
+        path: birding-feedback.db
+      shelf_expiration: null
     SearchManager:
       class: birding.twitter.TwitterSearchManagerFromOAuth
       init: {}
@@ -41,6 +53,14 @@ Defaults::
       shelf_class: FreshLRUShelf
       shelf_init: {}
       shelf_expiration: 300
+      shelf_stats_interval: null # seconds between logging shelf stats, or null
+      batch_size: null # terms to search together in OR queries, null to not
+      batch_age: 5 # seconds to hold a batch, checked on each tuple and tick
+      concurrency: null # searches in flight per task, null to search in turn
+    TwitterLookupBolt:
+      batch_size: null # status IDs to look up across tuples, null to not batch
+      batch_age: 5 # seconds to hold a batch, checked on each tuple and tick
+      manager_stats_interval: null # seconds between logging manager stats
     ElasticsearchIndexBolt:
       elasticsearch_class: elasticsearch.Elasticsearch
       elasticsearch_init:
@@ -56,6 +76,7 @@ Defaults::
       shelf_class: ElasticsearchShelf
       shelf_init: {}
       shelf_expiration: null
+      shelf_stats_interval: null
     Appendix: {}
 
 """
@@ -79,14 +100,33 @@ BIRDING_CONF = os.environ.get('BIRDING_CONF', BIRDING_CONF_DEFAULT)
 SCHEMA = tv.SchemaMapping().of(
     Spout = tv.String(),
     TermCycleSpout = tv.SchemaMapping().of(
-        terms = tv.List().of(tv.String())),
+        terms = tv.List().of(tv.String()),
+        skip_fresh = tv.Boolean(),
+        term_source_class = tv.Optional(tv.String()),
+        term_source_init = tv.StrMapping().of(tv.Passthrough())),
+    AdaptiveTermSpout = tv.SchemaMapping().of(
+        min_interval = tv.Int(),
+        max_interval = tv.Int(),
+        target_count = tv.Int(),
+        smoothing = tv.Number(),
+        shelf_class = tv.String(),
+        shelf_init = tv.StrMapping().of(tv.Passthrough()),
+        shelf_expiration = tv.Optional(tv.Int())),
     SearchManager = tv.SchemaMapping().of(**{
         'class': tv.String(),
         'init': tv.StrMapping().of(tv.Passthrough())}),
     TwitterSearchBolt = tv.SchemaMapping().of(
         shelf_class = tv.String(),
         shelf_init = tv.StrMapping().of(tv.Passthrough()),
-        shelf_expiration = tv.Optional(tv.Int())),
+        shelf_expiration = tv.Optional(tv.Int()),
+        shelf_stats_interval = tv.Optional(tv.Int()),
+        batch_size = tv.Optional(tv.Int()),
+        batch_age = tv.Int(),
+        concurrency = tv.Optional(tv.Int())),
+    TwitterLookupBolt = tv.SchemaMapping().of(
+        batch_size = tv.Optional(tv.Int()),
+        batch_age = tv.Int(),
+        manager_stats_interval = tv.Optional(tv.Int())),
     ElasticsearchIndexBolt = tv.SchemaMapping().of(
         elasticsearch_class = tv.String(),
         elasticsearch_init = tv.StrMapping().of(tv.Passthrough()),
@@ -98,7 +138,8 @@ SCHEMA = tv.SchemaMapping().of(
         topic = tv.String(),
         shelf_class = tv.String(),
         shelf_init = tv.StrMapping().of(tv.Passthrough()),
-        shelf_expiration = tv.Optional(tv.Int())),
+        shelf_expiration = tv.Optional(tv.Int()),
+        shelf_stats_interval = tv.Optional(tv.Int())),
     Appendix = tv.Passthrough())
 
 
@@ -1,10 +1,24 @@
 """Minimal Gnip API using HTTP requests."""
 
+import calendar
+import codecs
+import collections
+import json
+import re
 import textwrap
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import requests
 
-from .search import SearchManager
+from .ratelimit import RateScheduler
+from .search import SearchManager, iter_limited
+from .shelf import LatencyHistogram
 
 
 class Gnip(object):
@@ -17,26 +31,101 @@ class Gnip(object):
         'maxResults': 500,
     }
 
-    def __init__(self, base_url, stream, username, password, **params):
-        """Prepare HTTP session for gnip searches."""
+    #: Nominal rate limits of endpoints, as documented by gnip for search.
+    default_rate_limits = {
+        'search': {'limit': 60, 'window': 60},
+    }
+
+    #: Minimum number of recent latencies to adapt timeouts and hedge.
+    min_samples = 20
+
+    #: Multiple of the `timeout_percentile` latency to time out requests.
+    timeout_factor = 3
+
+    #: Lowest adaptive timeout, in seconds.
+    min_timeout = 1.0
+
+    def __init__(self, base_url, stream, username, password,
+                 rate_limits=None, max_wait=10, timeout=30,
+                 timeout_percentile=None, hedge_percentile=None,
+                 latency_window=200, **params):
+        """Prepare HTTP session for gnip searches.
+
+        Searches are paced by a :class:`~birding.ratelimit.RateScheduler`,
+        on the ``search`` endpoint, within `default_rate_limits` updated with
+        any `rate_limits` given. A search which would wait longer than
+        `max_wait` seconds raises :class:`~birding.ratelimit.RateLimitError`
+        instead. Gnip sends no rate limit headers, but a 429 response backs
+        off.
+
+        Requests time out after `timeout` seconds. Given a
+        `timeout_percentile`, e.g. 99, requests instead time out after
+        `timeout_factor` times that percentile of the last `latency_window`
+        request latencies, at most `timeout` seconds. Given a
+        `hedge_percentile`, e.g. 95, a search which takes longer than that
+        percentile sends a duplicate request, see :meth:`hedged_get`.
+        """
         self.base_url = base_url
         self.stream = stream
         self.username = username
         self.password = password
+        limits = dict(self.default_rate_limits)
+        limits.update(rate_limits or {})
+        self.scheduler = RateScheduler(limits, max_wait=max_wait)
+        self.timeout = timeout
+        self.timeout_percentile = timeout_percentile
+        self.hedge_percentile = hedge_percentile
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.latency = LatencyHistogram()
+        self.counts = collections.defaultdict(int)
 
         self.params = {} # Use on every search.
         self.params.update(self.default_params)
         self.params.update(params)
 
-        self.session = self.start_session()
+        # Idle sessions, as each request uses a session of its own.
+        self.sessions = queue.LifoQueue()
+        self.sessions.put(self.start_session())
 
     def start_session(self):
         session = self.session_class()
         session.auth = (self.username, self.password)
         return session
 
+    def checkout_session(self):
+        """Get an idle session, or a new one if all are in use.
+
+        Requests sessions are not thread-safe, so concurrent and hedged
+        requests each use their own session. Put it back once done.
+        """
+        try:
+            return self.sessions.get_nowait()
+        except queue.Empty:
+            return self.start_session()
+
     def search(self, q, **kw):
-        """Search Gnip for given query, returning deserialized response."""
+        """Search Gnip for given query, returning deserialized response.
+
+        The response is decoded as it downloads, see :meth:`search_stream`,
+        rather than after the whole body is read.
+        """
+        results = self.search_stream(q, **kw)
+        activities = list(results)
+        return dict(results.response, results=activities)
+
+    def search_stream(self, q, **kw):
+        """Search Gnip for given query, returning a :class:`ResultStream`.
+
+        Activities are decoded as the response downloads, see
+        :class:`ResultStream`.
+        """
+        return ResultStream(self.request(q, kw, stream=True))
+
+    def request(self, q, kw, stream=False):
+        """Request search for given query, returning HTTP response.
+
+        With `stream`, the response body is not yet downloaded.
+        """
         url = '{base_url}/search/{stream}'.format(**vars(self))
 
         params = {
@@ -45,14 +134,258 @@ class Gnip(object):
         params.update(self.params)
         params.update(kw)
 
-        response = self.session.get(url, params=params)
+        start = time.time()
+        if self.hedge_percentile is None:
+            response = self.get(url, params, stream=stream)
+        else:
+            response = self.hedged_get(url, params, stream=stream)
+        self.latency.observe(time.time() - start)
         response.raise_for_status()
-        return response.json()
+        return response
+
+    def get(self, url, params, stream=False):
+        """Request GET `url`, with adaptive timeout, within rate limits."""
+        self.scheduler.wait('search')
+        timeout = self.request_timeout()
+        session = self.checkout_session()
+        start = time.time()
+        try:
+            response = session.get(
+                url, params=params, timeout=timeout, stream=stream)
+        except requests.Timeout:
+            self.counts['timeouts'] += 1
+            self.latencies.append(timeout)
+            raise
+        finally:
+            self.sessions.put(session)
+        self.latencies.append(time.time() - start)
+        self.scheduler.update(
+            'search', response.headers, status=response.status_code)
+        return response
+
+    def hedged_get(self, url, params, stream=False):
+        """Request GET `url`, duplicating the request if it is slow.
+
+        Once the request takes longer than the `hedge_percentile` of recent
+        latencies, a duplicate request is sent if within rate limits. The
+        first response is used, and the other is closed once it arrives, as
+        requests cannot cancel a request in flight.
+        """
+        results = queue.Queue()
+
+        def attempt(hedge):
+            try:
+                results.put(
+                    (self.get(url, params, stream=stream), None, hedge))
+            except Exception as e:
+                results.put((None, e, hedge))
+
+        def close_other():
+            response, _, _ = results.get()
+            if response is not None:
+                response.close()
+
+        start_thread(attempt, False)
+        pending = 1
+        delay = self.recent_percentile(self.hedge_percentile)
+        while True:
+            try:
+                response, error, hedge = results.get(timeout=delay)
+            except queue.Empty:
+                delay = None
+                if self.scheduler.delay('search') == 0:
+                    self.counts['hedges'] += 1
+                    start_thread(attempt, True)
+                    pending += 1
+                continue
+            pending -= 1
+            if error is None or not pending:
+                break
+        if pending:
+            start_thread(close_other)
+        if error is not None:
+            raise error
+        if hedge:
+            self.counts['hedge_wins'] += 1
+        return response
+
+    def request_timeout(self):
+        """Get timeout of next request, adapted to recent latencies."""
+        if self.timeout_percentile is None:
+            return self.timeout
+        latency = self.recent_percentile(self.timeout_percentile)
+        if latency is None:
+            return self.timeout
+        timeout = max(self.min_timeout, self.timeout_factor * latency)
+        if self.timeout is not None:
+            timeout = min(timeout, self.timeout)
+        return timeout
+
+    def recent_percentile(self, percent):
+        """Get percentile of recent latencies, None without `min_samples`."""
+        if percent is None or len(self.latencies) < self.min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        rank = int(percent / 100.0 * len(latencies))
+        return latencies[min(rank, len(latencies) - 1)]
+
+    def latency_stats(self):
+        """Get latency histogram of searches, with current timeouts."""
+        stats = dict(self.counts)
+        stats['latency'] = self.latency.snapshot()
+        stats['timeout'] = self.request_timeout()
+        stats['hedge_delay'] = self.recent_percentile(self.hedge_percentile)
+        return stats
+
+    def stream_pages(self, q, **kw):
+        """Search Gnip for given query, lazily yielding a stream of each page.
+
+        Each next page is requested with the ``next`` token of the previous
+        page, once that page is consumed.
+        """
+        while True:
+            results = self.search_stream(q, **kw)
+            yield results
+            next_token = results.response.get('next')
+            if not next_token:
+                return
+            kw['next'] = next_token
+
+
+class ResultStream(object):
+    """Iterate activities of a search response as the response downloads.
+
+    The ``results`` array is decoded incrementally from the (possibly
+    gzip-compressed) body of the HTTP `response`, one activity at a time, so
+    that memory use is in proportion to one activity and not to the page.
+    Other top-level values, e.g. ``next``, are in the `response` dict once
+    read, and all are read once iteration completes. The HTTP response is
+    closed once iteration stops.
+
+    >>> class Response(object):
+    ...     def iter_content(self, chunk_size):
+    ...         yield '{"results": [{"id": 1}, {"i'
+    ...         yield 'd": 2}], "next": "x"}'
+    ...     def close(self):
+    ...         pass
+    ...
+    >>> results = ResultStream(Response())
+    >>> [activity['id'] for activity in results]
+    [1, 2]
+    >>> results.response['next']
+    u'x'
+    >>>
+    """
+
+    #: Bytes to read from the HTTP response at once.
+    chunk_size = 65536
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, response, key='results'):
+        self.http_response = response
+        self.key = key
+        self.response = {}
+        self.chunks = response.iter_content(self.chunk_size)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.text = u''
+        self.pos = 0
+        self.items = self.parse()
+
+    def __iter__(self):
+        return self.items
+
+    def parse(self):
+        try:
+            self.expect('{')
+            if self.peek() == '}':
+                return
+            while True:
+                key = self.value()
+                self.expect(':')
+                if key == self.key:
+                    for item in self.array():
+                        yield item
+                else:
+                    self.response[key] = self.value()
+                if self.expect(',}') == '}':
+                    return
+        finally:
+            self.http_response.close()
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def value(self):
+        """Decode next JSON value, reading as much as needed."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.text) and self.fill():
+                # A number may continue into the next chunk.
+                continue
+            self.pos = end
+            return value
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(
+                'Expected {!r} at {!r}'.format(chars, self.text[self.pos:]))
+        self.pos += 1
+        return char
+
+    def peek(self):
+        """Get next non-whitespace character, reading as much as needed."""
+        while True:
+            self.pos = self.whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON response.')
+
+    def fill(self):
+        """Read next chunk of response, return False at end of response."""
+        for chunk in self.chunks:
+            text = self.utf8.decode(chunk)
+            if text:
+                self.text = self.text[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
 
 
 class GnipSearchManager(SearchManager):
     """Service object to provide fully-hydrated tweets given a search query."""
 
+    #: Maximum length of a search query, to coalesce terms.
+    max_query_length = 1024
+
+    #: Activities of search results are complete, with no lookup by ID.
+    has_lookup = False
+
+    has_statuses = True
+
     def __init__(self, *a, **kw):
         self.gnip = Gnip(*a, **kw)
 
@@ -63,6 +396,72 @@ class GnipSearchManager(SearchManager):
         """
         return self.gnip.search(q, **kw)
 
+    def rate_limit_stats(self):
+        """Get remaining rate limit budget and usage of search."""
+        return self.gnip.scheduler.stats()
+
+    def set_rate_limit_share(self, share):
+        """Pace searches at ``1 / share`` of rate limits."""
+        self.gnip.scheduler.set_share(share)
+
+    def latency_stats(self):
+        """Get latency of searches, see :meth:`Gnip.latency_stats`."""
+        return self.gnip.latency_stats()
+
+    def iter_search(self, q, max_pages=None, max_count=None, max_age=None,
+                    **kw):
+        """Search gnip for ``q``, lazily yielding activities across pages.
+
+        Activities are decoded as each page downloads, see
+        :meth:`Gnip.stream_pages` and :func:`~birding.search.iter_limited`.
+        """
+        pages = self.gnip.stream_pages(q, **kw)
+        return iter_limited(
+            pages,
+            status_time=self.status_time,
+            max_pages=max_pages,
+            max_count=max_count,
+            max_age=max_age)
+
+    @staticmethod
+    def search_result_statuses(result):
+        """Get list of activities in return value of :meth:`search`."""
+        return result['results']
+
+    @staticmethod
+    def search_result_ids(result):
+        """Get list of tweet ID strings in return value of :meth:`search`.
+
+        >>> GnipSearchManager.search_result_ids(
+        ...     {'results': [{'id': 'tag:search.twitter.com,2005:6296873'}]})
+        ['6296873']
+        >>>
+        """
+        return [
+            activity['id'].rsplit(':', 1)[-1]
+            for activity in result['results']]
+
+    @staticmethod
+    def status_time(status):
+        """Get UNIX timestamp of when activity was posted."""
+        posted = time.strptime(status['postedTime'][:19], '%Y-%m-%dT%H:%M:%S')
+        return calendar.timegm(posted)
+
+    def filter_result(self, result, match):
+        """Get copy of `result` with only activities whose text `match`."""
+        activities = [
+            activity for activity in result['results']
+            if match(self.status_text(activity))]
+        return dict(result, results=activities)
+
+    @staticmethod
+    def status_text(status):
+        """Get text of activity to match search terms."""
+        text = [status['body'], status['actor']['preferredUsername']]
+        for url in status.get('twitter_entities', {}).get('urls', []):
+            text.append(url.get('expanded_url') or '')
+        return u'\n'.join(text)
+
     def lookup_search_result(self, result, **kw):
         """Do almost nothing, just pass-through results."""
         return result['results']
@@ -0,0 +1,269 @@
+"""Pace API requests within rate limits, shared by search managers."""
+
+import threading
+import time
+
+
+class RateLimitError(Exception):
+    """Raised when a request would wait longer than allowed for rate limits."""
+
+
+class TokenBucket(object):
+    """Pace requests to one endpoint to `limit` requests per `window` seconds.
+
+    Tokens refill continuously at ``limit / window`` per second, up to `burst`
+    tokens, such that requests are spread evenly across the window instead of
+    bursting at its start. When the API reports its remaining budget and reset
+    time (see :meth:`update`), the refill rate is adjusted to spread the
+    remaining budget evenly until the reset. When `share` tasks each pace
+    requests with the same credentials, each task refills at its share of
+    the rate.
+
+    >>> now = [0.0]
+    >>> bucket = TokenBucket(10, 100, clock=lambda: now[0])
+    >>> bucket.delay()
+    0.0
+    >>> bucket.take()
+    >>> bucket.delay()
+    10.0
+    >>> bucket.update(limit=10, remaining=2, reset=40)
+    >>> bucket.delay()
+    20.0
+    >>> bucket.set_share(2)
+    >>> bucket.delay()
+    40.0
+    >>>
+    """
+
+    def __init__(self, limit, window, burst=1, share=1, clock=time.time):
+        self.limit = limit
+        self.window = window
+        self.burst = burst
+        self.share = share
+        self.clock = clock
+
+        self.rate = float(limit) / window / share
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.remaining = None # As reported by API, until `reset`.
+        self.reset = None
+
+        self.requests = 0
+        self.waited = 0.0
+
+    def refill(self):
+        now = self.clock()
+        if self.reset is not None and now >= self.reset:
+            # The API's window has reset; go back to the nominal rate.
+            self.rate = float(self.limit) / self.window / self.share
+            self.remaining = None
+            self.reset = None
+        elapsed = now - self.updated
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Get number of seconds to wait before the next request."""
+        self.refill()
+        if self.remaining == 0:
+            return max(0.0, self.reset - self.clock())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Take a token for a request, which should be made now."""
+        self.refill()
+        self.tokens -= 1
+        self.requests += 1
+        if self.remaining:
+            self.remaining -= 1
+
+    def update(self, limit, remaining, reset):
+        """Update with `remaining` requests allowed until `reset` UNIX time."""
+        self.refill()
+        if limit:
+            self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        until_reset = reset - self.clock()
+        if remaining > 0 and until_reset > 0:
+            self.rate = float(remaining) / until_reset / self.share
+        elif remaining == 0:
+            self.tokens = min(self.tokens, 0.0)
+
+    def set_share(self, share):
+        """Pace at ``1 / share`` of the rate, when `share` tasks share it."""
+        self.refill()
+        self.rate = self.rate * self.share / share
+        self.share = share
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'window': self.window,
+            'remaining': self.remaining,
+            'reset': self.reset,
+            'rate': self.rate,
+            'share': self.share,
+            'requests': self.requests,
+            'waited': self.waited,
+        }
+
+
+class RateScheduler(object):
+    """Pace requests across API endpoints, with a `TokenBucket` for each.
+
+    `limits` is a dict of endpoint name to a dict of ``limit`` and ``window``,
+    as nominal rate limits before the API reports any. Endpoints without
+    nominal limits are paced once the API reports limits in response headers,
+    or once the API responds 429, see :meth:`update`. Requests which would
+    wait longer than `max_wait` seconds raise `RateLimitError` instead, as to
+    defer the request, e.g. to fail a tuple well within Storm's message
+    timeout rather than block its task until a rate limit window resets. A
+    `max_wait` of None waits as long as needed.
+
+    When several tasks use the same credentials, each with its own scheduler,
+    set their number as `share` (see :meth:`set_share`), as to pace each task
+    at its share of the rate limits.
+
+    Use :meth:`wait` before each request and :meth:`update` with the headers
+    of each response, including error responses. Requests from several
+    threads each reserve their turn, then wait without blocking others.
+
+    >>> now = [0.0]
+    >>> scheduler = RateScheduler(clock=lambda: now[0])
+    >>> scheduler.delay('search')
+    0.0
+    >>> scheduler.update('search', {'retry-after': '30'}, status=429)
+    >>> scheduler.delay('search')
+    30.0
+    >>>
+    """
+
+    #: Seconds to back off on a 429 of an endpoint with no known limits.
+    backoff = 60
+
+    def __init__(self, limits=None, burst=1, max_wait=10, share=1,
+                 clock=time.time, sleep=time.sleep):
+        self.burst = burst
+        self.max_wait = max_wait
+        self.share = share
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = {}
+        for endpoint, limit in (limits or {}).items():
+            self.buckets[endpoint] = self.new_bucket(
+                limit['limit'], limit['window'])
+
+    def new_bucket(self, limit, window):
+        return TokenBucket(
+            limit, window, burst=self.burst, share=self.share,
+            clock=self.clock)
+
+    def set_share(self, share):
+        """Pace requests at ``1 / share`` of the rate limits of endpoints."""
+        with self.lock:
+            self.share = share
+            for bucket in self.buckets.values():
+                bucket.set_share(share)
+
+    def wait(self, endpoint):
+        """Wait until a request to `endpoint` is within its rate limit.
+
+        The request's token is taken before waiting, as to reserve its turn,
+        such that concurrent requests wait in turn for later tokens.
+        """
+        with self.lock:
+            bucket = self.buckets.get(endpoint)
+            if bucket is None:
+                return
+            delay = bucket.delay()
+            if self.max_wait is not None and delay > self.max_wait:
+                raise RateLimitError(
+                    '{} rate limited for {:.1f}s'.format(endpoint, delay))
+            bucket.take()
+            bucket.waited += delay
+        if delay > 0:
+            self.sleep(delay)
+
+    def delay(self, endpoint):
+        """Get number of seconds to wait before a request to `endpoint`."""
+        with self.lock:
+            bucket = self.buckets.get(endpoint)
+            if bucket is None:
+                return 0.0
+            return bucket.delay()
+
+    def remaining(self, endpoint):
+        """Get remaining budget of `endpoint`, as last known.
+
+        Before the API reports remaining budget, this is the nominal limit.
+        """
+        with self.lock:
+            bucket = self.buckets.get(endpoint)
+            if bucket is None:
+                return float('inf')
+            if bucket.remaining is None:
+                return bucket.limit
+            return bucket.remaining
+
+    def update(self, endpoint, headers, status=None):
+        """Update `endpoint` limits from response `headers`.
+
+        Reads ``x-rate-limit-*`` headers as sent by Twitter. A 429 `status`
+        without these headers uses ``retry-after`` if given, else waits for a
+        full window, or `backoff` seconds if the endpoint has no limits yet.
+        An endpoint first limited by a 429 is then paced to one request per
+        second.
+        """
+        if headers is None:
+            headers = {}
+        now = self.clock()
+        limit = to_int(headers.get('x-rate-limit-limit'))
+        remaining = to_int(headers.get('x-rate-limit-remaining'))
+        reset = to_int(headers.get('x-rate-limit-reset'))
+        if status == 429:
+            remaining = 0
+            if reset is None:
+                retry_after = to_int(headers.get('retry-after'))
+                if retry_after is not None:
+                    reset = now + retry_after
+        if remaining is None:
+            return
+
+        with self.lock:
+            bucket = self.buckets.get(endpoint)
+            if bucket is None:
+                if status == 429:
+                    bucket = self.new_bucket(1, 1)
+                    if reset is None:
+                        reset = now + self.backoff
+                elif reset is None or not limit:
+                    return
+                else:
+                    bucket = self.new_bucket(limit, max(1, reset - now))
+                self.buckets[endpoint] = bucket
+            if reset is None:
+                reset = now + bucket.window
+            bucket.update(limit, remaining, reset)
+
+    def stats(self):
+        """Get a dict of endpoint to its remaining budget and usage."""
+        with self.lock:
+            return dict(
+                (endpoint, bucket.stats())
+                for endpoint, bucket in self.buckets.items())
+
+
+def to_int(value):
+    """Convert header value to int, or None if missing.
+
+    >>> to_int('180'), to_int(None)
+    (180, None)
+    >>>
+    """
+    if value is None:
+        return None
+    return int(value)
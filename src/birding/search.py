@@ -1,5 +1,7 @@
 """Search. Get tweets."""
 
+import re
+import time
 from abc import ABCMeta, abstractmethod
 
 from .config import import_name
@@ -19,6 +21,117 @@ def search_manager_from_config(config, **default_init):
     return manager
 
 
+def iter_limited(pages, status_time=None, max_pages=None, max_count=None,
+                 max_age=None):
+    """Yield statuses from lazy sequence of `pages`, stopping at limits.
+
+    Each page is a list of statuses, newest first. Iteration stops after
+    `max_pages` pages, after `max_count` statuses, or at the first status
+    which is more than `max_age` seconds old according to `status_time`, a
+    function of a status returning its UNIX timestamp. Pages are requested
+    only as needed.
+
+    >>> pages = iter([[{'t': 9}, {'t': 8}], [{'t': 7}], [{'t': 1}]])
+    >>> list(iter_limited(pages, max_count=2))
+    [{'t': 9}, {'t': 8}]
+    >>> list(iter_limited(pages, max_pages=1))
+    [{'t': 7}]
+    >>>
+    """
+    if max_age is not None:
+        oldest = time.time() - max_age
+    count = 0
+    for page_count, page in enumerate(pages, 1):
+        for status in page:
+            if max_age is not None and status_time(status) < oldest:
+                return
+            yield status
+            count += 1
+            if max_count is not None and count >= max_count:
+                return
+        if max_pages is not None and page_count >= max_pages:
+            return
+
+
+def term_matcher(term):
+    """Get a function of text which is True if `term` matches, or None.
+
+    Words of `term` must all match, as whole words, and quoted phrases match
+    as a whole; ``-word`` excludes a word. Case is ignored. Terms with other
+    search operators cannot be matched locally, and give None.
+
+    >>> match = term_matcher('apache storm')
+    >>> match('Storm is an Apache project'), match('a brainstorm')
+    (True, False)
+    >>> term_matcher('from:parsely') is None
+    True
+    >>>
+    """
+    tokens = re.findall(r'"([^"]+)"|(\S+)', term)
+    include, exclude = [], []
+    for phrase, word in tokens:
+        if phrase:
+            include.append(phrase)
+        elif word == 'OR' or any(c in word for c in ':()"'):
+            return None
+        elif word.startswith('-') and len(word) > 1:
+            exclude.append(word[1:])
+        else:
+            include.append(word)
+    if not include:
+        return None
+    include, exclude = (
+        [re.compile(r'(?<!\w)' + re.escape(t) + r'(?!\w)', re.I | re.U)
+         for t in token_list]
+        for token_list in (include, exclude))
+
+    def match(text):
+        return (
+            all(regex.search(text) for regex in include) and
+            not any(regex.search(text) for regex in exclude))
+    return match
+
+
+def or_query(terms):
+    """Get a query for any of `terms`, grouping terms of several words.
+
+    >>> or_query(['pypi', 'apache storm', '"real-time analytics"'])
+    'pypi OR (apache storm) OR "real-time analytics"'
+    >>>
+    """
+    parts = []
+    for term in terms:
+        if re.match(r'^("[^"]+"|\S+)$', term):
+            parts.append(term)
+        else:
+            parts.append('({})'.format(term))
+    return ' OR '.join(parts)
+
+
+def pack_terms(terms, max_length=None):
+    """Pack `terms` into lists, each to search as one :func:`or_query`.
+
+    Terms are packed in order such that each query is at most `max_length`
+    characters. Terms which cannot be matched locally (see
+    :func:`term_matcher`) are in lists of their own, as are all terms without
+    a `max_length`.
+
+    >>> pack_terms(['pypi', 'apache storm', 'from:parsely', 'storm'], 40)
+    [['pypi', 'apache storm', 'storm'], ['from:parsely']]
+    >>>
+    """
+    packs, pack = [], []
+    for term in terms:
+        if max_length is None or term_matcher(term) is None:
+            packs.append([term])
+        elif pack and len(or_query(pack + [term])) <= max_length:
+            pack.append(term)
+        else:
+            pack = [term]
+            packs.append(pack)
+    return packs
+
+
 class SearchManager(object):
     """Abstract base class for service object to search for tweets."""
 
@@ -28,6 +141,84 @@ class SearchManager(object):
     def search(self, q=None, **kw):
         """Search for ``q``, return results directly from source."""
 
+    def iter_search(self, q=None, max_pages=None, max_count=None,
+                    max_age=None, **kw):
+        """Search for ``q``, lazily yielding statuses across result pages.
+
+        See :func:`iter_limited` for limits. Not implemented by default.
+        """
+        raise NotImplementedError('Paginated search is not implemented.')
+
+    #: Maximum length of a search query to coalesce terms, None to not.
+    max_query_length = None
+
+    def search_many(self, terms, **kw):
+        """Search for each of `terms`, return dict of term to search result.
+
+        Terms are coalesced into OR queries of up to `max_query_length`
+        characters (see :func:`pack_terms`), and statuses of each query result
+        are attributed back to each term they match with :meth:`filter_result`.
+        Each term's result is then as if it were searched on its own, save for
+        statuses which a busier term in the same query crowds out.
+        """
+        results = {}
+        for pack in pack_terms(terms, self.max_query_length):
+            if len(pack) == 1:
+                results[pack[0]] = self.search(q=pack[0], **kw)
+                continue
+            result = self.search(q=or_query(pack), **kw)
+            for term in pack:
+                results[term] = self.filter_result(result, term_matcher(term))
+        return results
+
+    def filter_result(self, result, match):
+        """Get copy of search `result` with only statuses whose text `match`.
+
+        Required to coalesce terms, i.e. where `max_query_length` is set, see
+        :meth:`search_many`.
+        """
+        raise NotImplementedError('Filtering results is not implemented.')
+
+    #: Whether :meth:`search_result_statuses`, :meth:`search_result_ids` and
+    #: :meth:`status_time` are implemented, as to feed back search results.
+    has_statuses = False
+
+    def search_result_statuses(self, result):
+        """Get list of statuses in return value of :meth:`search`.
+
+        Not implemented by default.
+        """
+        raise NotImplementedError('Listing statuses is not implemented.')
+
+    def search_result_ids(self, result):
+        """Get list of status ID strings in return value of :meth:`search`.
+
+        Not implemented by default.
+        """
+        raise NotImplementedError('Listing status IDs is not implemented.')
+
+    def status_time(self, status):
+        """Get UNIX timestamp of status. Not implemented by default."""
+        raise NotImplementedError('Status time is not implemented.')
+
+    def rate_limit_stats(self):
+        """Get remaining rate limit budget by endpoint, empty by default."""
+        return {}
+
+    def set_rate_limit_share(self, share):
+        """Pace requests at ``1 / share`` of rate limits, no-op by default.
+
+        Bolts set `share` to their number of tasks, each of which has its own
+        manager using the same credentials.
+        """
+
+    def latency_stats(self):
+        """Get latency of requests, empty by default."""
+        return {}
+
+    #: Whether :meth:`lookup` looks up statuses by ID, as to batch lookups.
+    has_lookup = True
+
     @abstractmethod
     def lookup_search_result(self, result, **kw):
         """Perform :meth:`lookup` on return value of :meth:`search`."""
@@ -1,11 +1,25 @@
 """Track terms using a simple dict-like interface."""
 
 import abc
+import array
+import atexit
+import bisect
 import collections
+import hashlib
+import inspect
+import json
+import math
+import os
+import pickle
+import sqlite3
+import struct
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 import elasticsearch
-from repoze.lru import LRUCache
+import elasticsearch.helpers
+from repoze.lru import ExpiringLRUCache, LRUCache
 
 from .config import import_name
 
@@ -13,15 +27,61 @@ from .config import import_name
 UNSET = object()
 
 
+def get_uint64_typecode():
+    """Get the `array` typecode for unsigned 64-bit integers."""
+    for typecode in ('Q', 'L'):
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            # Typecode is not supported by this Python version.
+            continue
+    raise RuntimeError('No array typecode for unsigned 64-bit integers.')
+
+
+UINT64_TYPECODE = get_uint64_typecode()
+
+
+def key_bytes(key):
+    """Get a byte string of `key`, e.g. for hashing.
+
+    >>> key_bytes(u'caf\\xe9'), key_bytes(42)
+    ('caf\\xc3\\xa9', '42')
+    >>>
+    """
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return str(key)
+
+
+def key_text(key):
+    """Get a unicode string of `key`, as Elasticsearch returns document IDs.
+
+    >>> key_text('caf\\xc3\\xa9'), key_text(42)
+    (u'caf\\xe9', u'42')
+    >>>
+    """
+    if isinstance(key, str):
+        return key.decode('utf-8')
+    return unicode(key)
+
+
 def shelf_from_config(config, **default_init):
     """Get a `Shelf` instance dynamically based on config.
 
     `config` is a dictionary containing ``shelf_*`` keys as defined in
-    :mod:`birding.config`.
+    :mod:`birding.config`. Defaults in `default_init`, e.g. an ``index``
+    given by a bolt, apply only to shelf classes which take them.
+
+    >>> shelf = shelf_from_config(
+    ...     {'shelf_class': 'LRUShelf', 'shelf_init': {}}, index='bolt_shelf')
+    >>> type(shelf).__name__
+    'LRUShelf'
+    >>>
     """
     shelf_cls = import_name(config['shelf_class'], default_ns='birding.shelf')
     init = {}
-    init.update(default_init)
+    init.update(takes_init(shelf_cls, default_init))
     init.update(config['shelf_init'])
     shelf = shelf_cls(**init)
     if hasattr(shelf, 'set_expiration') and 'shelf_expiration' in config:
@@ -29,14 +89,136 @@ def shelf_from_config(config, **default_init):
     return shelf
 
 
+def takes_init(cls, init):
+    """Get items of `init` dict which are keyword arguments of `cls`."""
+    try:
+        spec = inspect.getargspec(cls.__init__)
+    except TypeError:
+        return {} # Not a Python function, e.g. object.__init__.
+    if spec.keywords is not None:
+        return dict(init)
+    return dict((k, v) for k, v in init.items() if k in spec.args)
+
+
+def get_feedback_shelf(config):
+    """Get shelf on which to feed back search results to spout, or None.
+
+    `config` is the full birding config. Only spouts with ``uses_feedback``,
+    e.g. :class:`~birding.spout.AdaptiveTermSpout`, read feedback, so there
+    is no shelf unless such a spout is configured. The shelf is configured
+    with ``shelf_*`` keys of ``AdaptiveTermSpout``.
+    """
+    spout_class = import_name(config['Spout'], default_ns='birding.spout')
+    if not getattr(spout_class, 'uses_feedback', False):
+        return None
+    return shelf_from_config(config['AdaptiveTermSpout'])
+
+
+class LatencyHistogram(object):
+    """Histogram of operation latencies, in seconds.
+
+    >>> histogram = LatencyHistogram()
+    >>> for latency in (0.0002, 0.003, 0.004, 0.2):
+    ...     histogram.observe(latency)
+    ...
+    >>> histogram.percentile(50), histogram.percentile(99)
+    (0.005, 0.25)
+    >>>
+    """
+
+    #: Upper bounds of histogram buckets, in seconds.
+    bounds = (
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0,
+        float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, latency):
+        self.counts[bisect.bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percent):
+        """Get upper bound of the bucket holding the given percentile."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float('inf') else self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class ShelfStats(object):
+    """Counters and latency histograms of operations on a shelf.
+
+    Counters include ``hits``, ``misses``, ``stale`` (values found but
+    rejected by ``unpack``, e.g. by `FreshPacker`), ``writes`` and, where a
+    shelf evicts keys, ``evictions``.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counts = collections.defaultdict(int)
+        self.latencies = collections.defaultdict(LatencyHistogram)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def observe(self, operation, start):
+        """Observe latency of `operation` begun at `start` time."""
+        self.latencies[operation].observe(time.time() - start)
+
+    def snapshot(self):
+        """Get a dict of all stats, suitable to serialize as JSON."""
+        counts = dict(self.counts)
+        hits = counts.get('hits', 0)
+        lookups = hits + counts.get('misses', 0) + counts.get('stale', 0)
+        return {
+            'seconds': time.time() - self.started,
+            'counts': counts,
+            'hit_ratio': hits / float(lookups) if lookups else None,
+            'latency': dict(
+                (operation, histogram.snapshot())
+                for operation, histogram in self.latencies.items()),
+        }
+
+
 class Shelf(collections.MutableMapping):
     """Abstract base class for a shelf to track -- but not iterate -- values.
 
     Provides a dict-interface.
+
+    Counters of `stats` are always kept, while latencies are only observed
+    once enabled with :meth:`set_timed`, as timing every lookup is several
+    times the cost of a lookup on an in-memory shelf.
     """
 
     __metaclass__ = abc.ABCMeta
 
+    #: Whether to observe latency of operations in `stats`.
+    timed = False
+
     @abc.abstractmethod
     def getitem(self, key):
         """Get an item's value from the shelf or raise KeyError(key)."""
@@ -53,6 +235,42 @@ class Shelf(collections.MutableMapping):
     def clear(self):
         """Remove all items from the shelf."""
 
+    def getitems(self, keys):
+        """Get a dict of values for those `keys` which are on the shelf.
+
+        Missing keys are omitted from the result. This default calls
+        ``getitem`` once per key; override it where the backing store has a
+        native multi-get.
+        """
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self.getitem(key)
+            except KeyError:
+                continue
+        return result
+
+    def setitems(self, items):
+        """Set a sequence of (key, value) pairs on the shelf.
+
+        This default calls ``setitem`` once per pair; override it where the
+        backing store has a native bulk write.
+        """
+        for key, value in items:
+            self.setitem(key, value)
+
+    def flush(self):
+        """Write any buffered values to the backing store.
+
+        Shelves which buffer writes override this; by default it does nothing.
+        """
+
+    def maintain(self):
+        """Perform periodic upkeep, e.g. evicting stale values.
+
+        Bolts call this regularly while processing. By default it does nothing.
+        """
+
     def unpack(self, key, value):
         """Unpack value from ``getitem``.
 
@@ -69,18 +287,104 @@ class Shelf(collections.MutableMapping):
         """Pack value given to ``setitem``, inverse of ``unpack``."""
         return value
 
+    @property
+    def stats(self):
+        """`ShelfStats` of operations on this shelf, created on first use."""
+        if 'shelf_stats' not in self.__dict__:
+            self.shelf_stats = ShelfStats()
+        return self.shelf_stats
+
+    def stats_snapshot(self):
+        """Get a dict snapshot of `stats`, see :meth:`ShelfStats.snapshot`."""
+        return self.stats.snapshot()
+
+    def set_timed(self, timed=True):
+        """Set whether to observe latency of operations in `stats`.
+
+        >>> shelf = LRUShelf()
+        >>> shelf.set_timed()
+        >>> shelf['key'] = 'value'
+        >>> shelf.stats.latencies['set'].count
+        1
+        >>>
+        """
+        self.timed = timed
+
     def __getitem__(self, key):
-        return self.unpack(key, self.getitem(self.__keytransform__(key)))
+        start = time.time() if self.timed else None
+        stats = self.stats
+        try:
+            value = self.getitem(self.__keytransform__(key))
+        except KeyError:
+            stats.count('misses')
+            raise
+        else:
+            try:
+                value = self.unpack(key, value)
+            except KeyError:
+                stats.count('stale')
+                raise
+            stats.count('hits')
+            return value
+        finally:
+            if start is not None:
+                stats.observe('get', start)
 
     def __setitem__(self, key, value):
+        start = time.time() if self.timed else None
         self.setitem(self.__keytransform__(key), self.pack(key, value))
+        self.stats.count('writes')
+        if start is not None:
+            self.stats.observe('set', start)
 
     def __delitem__(self, key):
+        start = time.time() if self.timed else None
         self.delitem(self.__keytransform__(key))
+        if start is not None:
+            self.stats.observe('delete', start)
 
     def __keytransform__(self, key):
         return key
 
+    def get_many(self, keys):
+        """Get a dict of unpacked values of those `keys` found on the shelf.
+
+        This is the batch form of ``__getitem__``, such that keys which are
+        missing or which ``unpack`` rejects are omitted from the result.
+        """
+        start = time.time() if self.timed else None
+        key_map = dict((self.__keytransform__(key), key) for key in keys)
+        found = self.getitems(list(key_map))
+        result = {}
+        for shelf_key, value in found.items():
+            key = key_map[shelf_key]
+            try:
+                result[key] = self.unpack(key, value)
+            except KeyError:
+                self.stats.count('stale')
+                continue
+        self.stats.count('hits', len(result))
+        self.stats.count('misses', len(key_map) - len(found))
+        if start is not None:
+            self.stats.observe('get_many', start)
+        return result
+
+    def set_many(self, items):
+        """Set many values, given a mapping or sequence of (key, value) pairs.
+
+        This is the batch form of ``__setitem__``.
+        """
+        if isinstance(items, collections.Mapping):
+            items = items.items()
+        start = time.time() if self.timed else None
+        items = [
+            (self.__keytransform__(key), self.pack(key, value))
+            for key, value in items]
+        self.setitems(items)
+        self.stats.count('writes', len(items))
+        if start is not None:
+            self.stats.observe('set_many', start)
+
     def __iter__(self):
         raise NotImplementedError('Shelf instances do not support iteration.')
 
@@ -141,21 +445,583 @@ class LRUShelf(Shelf):
     def clear(self):
         self.store.clear()
 
+    def stats_snapshot(self):
+        snapshot = super(LRUShelf, self).stats_snapshot()
+        snapshot['counts']['evictions'] = self.store.evictions
+        return snapshot
+
 
 class FreshLRUShelf(FreshPacker, LRUShelf):
     """A Least-Recently Used shelf which expires values."""
 
 
+class ExpiringLRUShelf(FreshPacker, Shelf):
+    """A Least-Recently Used shelf which actively evicts stale values.
+
+    Unlike `FreshLRUShelf`, which only finds stale values when they are read,
+    this shelf tracks keys in order of when they were written. Since all
+    values expire after the same time, stale keys are always at the front of
+    that order, and are evicted in O(1) amortized time on every write and on
+    ``maintain``. Capacity up to `maxsize` therefore holds fresh values.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = int(maxsize)
+        # Both are ordered oldest first; `store` by use, `written` by write.
+        self.store = collections.OrderedDict()
+        self.written = collections.OrderedDict()
+
+    def getitem(self, key):
+        value = self.store.pop(key, UNSET)
+        if value is UNSET:
+            raise KeyError(key)
+        self.store[key] = value
+        return value
+
+    def setitem(self, key, value):
+        self.store.pop(key, None)
+        self.store[key] = value
+        self.written.pop(key, None)
+        self.written[key] = self.freshness()
+        self.evict_stale()
+        while len(self.store) > self.maxsize:
+            key, _ = self.store.popitem(last=False)
+            del self.written[key]
+            self.stats.count('evictions')
+
+    def delitem(self, key):
+        self.store.pop(key, None)
+        self.written.pop(key, None)
+
+    def clear(self):
+        self.store.clear()
+        self.written.clear()
+
+    def maintain(self):
+        self.evict_stale()
+
+    def evict_stale(self):
+        """Evict all stale values, stopping at the first fresh value."""
+        while self.written:
+            key = next(iter(self.written))
+            if self.is_fresh(self.written[key]):
+                break
+            del self.written[key]
+            del self.store[key]
+            self.stats.count('expirations')
+
+
+class SizedLRUShelf(Shelf):
+    """A Least-Recently Used shelf up to `max_json_size` of values.
+
+    Size is the length of each value serialized as compact JSON, which is
+    cheap to measure and in proportion to the size of large values, e.g.
+    fully-hydrated statuses, such that the shelf can bound their memory. It
+    is only an estimate of memory use, which is a few times more for the
+    decoded Python objects.
+    """
+
+    #: Encoder to measure size of values, skipping the check for cycles.
+    encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+    def __init__(self, max_json_size=16 * 1024 * 1024):
+        self.max_json_size = int(max_json_size)
+        self.json_size = 0
+        # Ordered least recently used first, of key to (value, size).
+        self.store = collections.OrderedDict()
+
+    def getitem(self, key):
+        item = self.store.pop(key, UNSET)
+        if item is UNSET:
+            raise KeyError(key)
+        self.store[key] = item
+        return item[0]
+
+    def setitem(self, key, value):
+        self.delitem(key)
+        size = len(self.encoder.encode(value))
+        if size > self.max_json_size:
+            return
+        self.store[key] = (value, size)
+        self.json_size += size
+        while self.json_size > self.max_json_size:
+            _, (_, evicted_size) = self.store.popitem(last=False)
+            self.json_size -= evicted_size
+            self.stats.count('evictions')
+
+    def delitem(self, key):
+        item = self.store.pop(key, UNSET)
+        if item is not UNSET:
+            self.json_size -= item[1]
+
+    def clear(self):
+        self.store.clear()
+        self.json_size = 0
+
+
+class FreshSizedLRUShelf(FreshPacker, SizedLRUShelf):
+    """A size-bounded Least-Recently Used shelf which expires values."""
+
+
+class IntegerSet(object):
+    """A fixed-capacity hash set of unsigned 64-bit integers.
+
+    Keys are stored in an `array` with open addressing and linear probing, as
+    to cost 8 bytes per slot instead of Python objects per key. The values 0
+    and 2**64-1 are reserved to mark empty and deleted slots. Callers must
+    keep the number of `used` slots below `capacity`.
+
+    >>> keys = IntegerSet(8)
+    >>> for key in (1, 9, 17):
+    ...     keys.add(key)
+    ...
+    >>> keys.home(1) == keys.home(9) == keys.home(17) # Probe past collisions.
+    True
+    >>> keys.discard(9)
+    >>> 9 in keys, 17 in keys # Probe past deleted slot.
+    (False, True)
+    >>> keys.add(9) # Reuse deleted slot.
+    >>> 9 in keys, keys.used
+    (True, 3)
+    >>>
+    """
+
+    EMPTY = 0
+    DELETED = 2 ** 64 - 1
+    MULTIPLIER = 0x9E3779B97F4A7C15 # 2**64 / golden ratio, Fibonacci hashing.
+
+    def __init__(self, capacity):
+        bits = max(1, int(capacity - 1).bit_length())
+        self.capacity = 1 << bits
+        self.mask = self.capacity - 1
+        self.shift = 64 - bits
+        self.slots = array.array(UINT64_TYPECODE, [self.EMPTY]) * self.capacity
+        self.used = 0 # Count of slots which are not empty, including deleted.
+
+    def home(self, key):
+        """Get the first slot index to probe for `key`."""
+        return ((key * self.MULTIPLIER) & self.DELETED) >> self.shift
+
+    def index(self, key):
+        """Get the slot index of `key`, or -1 if not in set."""
+        slots, i = self.slots, self.home(key)
+        while True:
+            slot = slots[i]
+            if slot == key:
+                return i
+            if slot == self.EMPTY:
+                return -1
+            i = (i + 1) & self.mask
+
+    def __contains__(self, key):
+        return self.index(key) != -1
+
+    def add(self, key):
+        if key in self:
+            return
+        slots, i = self.slots, self.home(key)
+        while slots[i] != self.EMPTY and slots[i] != self.DELETED:
+            i = (i + 1) & self.mask
+        if slots[i] == self.EMPTY:
+            self.used += 1
+        slots[i] = key
+
+    def discard(self, key):
+        i = self.index(key)
+        if i != -1:
+            self.slots[i] = self.DELETED
+
+
+class IntegerSetShelf(Shelf):
+    """A compact shelf of positive integer keys, e.g. tweet IDs.
+
+    Keys are held in a sequence of `generations` of `IntegerSet` tables, each
+    up to half full with ``maxsize / generations`` keys. Once the newest
+    generation is full, the oldest generation is dropped and a new one
+    started, such that the shelf holds at least the most recent ``maxsize *
+    (generations - 1) / generations`` keys written.
+
+    The shelf tracks only keys, not values. Any value can be set, and all keys
+    on the shelf have the value None. Keys can be any value accepted by
+    `int`, e.g. ``id_str`` values of statuses.
+
+    >>> shelf = IntegerSetShelf(maxsize=4, generations=2)
+    >>> for key in ('1', '2', '3', '4'):
+    ...     shelf[key] = None
+    ...
+    >>> '1' in shelf, '3' in shelf, '4' in shelf
+    (False, True, True)
+    >>> shelf.stats.counts['evictions']
+    2
+    >>>
+    """
+
+    def __init__(self, maxsize=1000000, generations=2):
+        self.generations = int(generations)
+        self.generation_size = max(1, -(-int(maxsize) // self.generations))
+        self.sets = collections.deque()
+        self.rotate()
+
+    def rotate(self):
+        """Start a new generation, dropping the oldest one if needed."""
+        if len(self.sets) >= self.generations:
+            self.stats.count('evictions', self.sets.popleft().used)
+        self.sets.append(IntegerSet(2 * self.generation_size))
+
+    def getitem(self, key):
+        for integer_set in reversed(self.sets):
+            if key in integer_set:
+                return None
+        raise KeyError(key)
+
+    def setitem(self, key, value):
+        current = self.sets[-1]
+        current.add(key)
+        if current.used >= self.generation_size:
+            self.rotate()
+
+    def delitem(self, key):
+        for integer_set in self.sets:
+            integer_set.discard(key)
+
+    def clear(self):
+        self.sets.clear()
+        self.rotate()
+
+    def __keytransform__(self, key):
+        key = int(key)
+        if not IntegerSet.EMPTY < key < IntegerSet.DELETED:
+            raise ValueError('Key out of range for integer set: {}'.format(
+                key))
+        return key
+
+
+class BloomFilter(object):
+    """A Bloom filter of byte string keys.
+
+    The filter is sized to hold `capacity` keys with a false positive rate of
+    `error_rate`. Keys are hashed with MD5 once, then `num_hashes` bit indices
+    are derived with double hashing.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(
+            math.log(2) * self.num_bits / capacity)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.created = time.time()
+
+    def indices(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key):
+        bits = self.bits
+        for i in self.indices(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        bits = self.bits
+        for i in self.indices(key):
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+
+class BloomShelf(Shelf):
+    """A probabilistic shelf of keys, using rotating Bloom filters.
+
+    Memory is constant: keys are added to the newest of up to `generations`
+    Bloom filters, each sized for `capacity` keys. Membership is checked
+    across all filters, with a false positive rate up to `error_rate` overall,
+    i.e. a key never set can be reported on the shelf at that rate. This suits
+    deduplication where an occasional false positive is acceptable.
+
+    A new filter is started, dropping the oldest, once the newest is full or,
+    given an expiration, when the newest filter is old enough. Keys are held
+    for at least the expiration, and at most ``generations / (generations -
+    1)`` times the expiration. Like `IntegerSetShelf`, this shelf tracks only
+    keys: all keys on the shelf have the value None, and keys cannot be
+    removed.
+
+    Given a `snapshot_path`, filters are saved to that file every
+    `snapshot_interval` seconds (on ``maintain``), on ``flush`` and at
+    interpreter exit, then loaded on init, as to remember keys across
+    restarts.
+
+    >>> shelf = BloomShelf(capacity=100)
+    >>> shelf.set_expiration(10)
+    >>> shelf['629687376452829184'] = None
+    >>> '629687376452829184' in shelf, '629687376452829185' in shelf
+    (True, False)
+    >>> shelf.filters[-1].created -= 10 # Newest filter is 10 seconds old.
+    >>> shelf['629687376452829185'] = None
+    >>> len(shelf.filters), '629687376452829184' in shelf
+    (2, True)
+    >>> for bloom_filter in shelf.filters:
+    ...     bloom_filter.created -= 20
+    ...
+    >>> '629687376452829184' in shelf, '629687376452829185' in shelf
+    (False, False)
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'bloom.pickle')
+    >>> shelf = BloomShelf(capacity=100, snapshot_path=path)
+    >>> shelf['629687376452829184'] = None
+    >>> shelf.flush()
+    >>> '629687376452829184' in BloomShelf(capacity=100, snapshot_path=path)
+    True
+    >>>
+    """
+
+    expire_after = None
+
+    def __init__(self, capacity=1000000, error_rate=0.001, generations=2,
+                 snapshot_path=None, snapshot_interval=60):
+        self.capacity = int(capacity)
+        self.generations = max(2, int(generations))
+        # Size filters such that a check across all of them is within target.
+        self.error_rate = float(error_rate) / self.generations
+        self.filters = collections.deque(maxlen=self.generations)
+
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_time = time.time()
+        if snapshot_path is not None:
+            self.load()
+            atexit.register(self.flush)
+        if not self.filters:
+            self.rotate()
+
+    def set_expiration(self, expire_after):
+        """Set minimum time, in seconds, for which keys are held."""
+        self.expire_after = expire_after
+
+    def rotate(self):
+        """Start a new filter, dropping the oldest one if needed."""
+        if len(self.filters) == self.generations:
+            self.stats.count('evictions', self.filters[0].count)
+        self.filters.append(BloomFilter(self.capacity, self.error_rate))
+
+    def expire(self):
+        """Drop and rotate filters as needed to expire keys."""
+        if self.expire_after is None:
+            return
+        interval = float(self.expire_after) / (self.generations - 1)
+        now = time.time()
+        while self.filters:
+            if now - self.filters[0].created < self.generations * interval:
+                break
+            self.stats.count('evictions', self.filters.popleft().count)
+        if not self.filters or now - self.filters[-1].created >= interval:
+            self.rotate()
+
+    def getitem(self, key):
+        self.expire()
+        for bloom_filter in self.filters:
+            if key in bloom_filter:
+                return None
+        raise KeyError(key)
+
+    def setitem(self, key, value):
+        self.expire()
+        current = self.filters[-1]
+        if key in current:
+            return
+        current.add(key)
+        if current.count >= self.capacity:
+            self.rotate()
+
+    def delitem(self, key):
+        raise NotImplementedError('BloomShelf does not support removal.')
+
+    def clear(self):
+        self.filters.clear()
+        self.rotate()
+
+    def maintain(self):
+        self.expire()
+        if self.snapshot_path is None:
+            return
+        if time.time() - self.snapshot_time >= self.snapshot_interval:
+            self.snapshot()
+
+    def flush(self):
+        if self.snapshot_path is not None:
+            self.snapshot()
+
+    def snapshot(self):
+        """Save filters to `snapshot_path`, replacing it atomically."""
+        self.snapshot_time = time.time()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            pickle.dump(list(self.filters), fd, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.snapshot_path)
+
+    def load(self):
+        """Load filters from `snapshot_path`, if saved with same sizing."""
+        if not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path, 'rb') as fd:
+            filters = pickle.load(fd)
+        expected = BloomFilter(self.capacity, self.error_rate)
+        for bloom_filter in filters:
+            if bloom_filter.num_bits != expected.num_bits:
+                return
+            if bloom_filter.num_hashes != expected.num_hashes:
+                return
+        self.filters.extend(filters)
+
+    def __keytransform__(self, key):
+        return key_bytes(key)
+
+
+class SQLiteShelf(Shelf):
+    """A shelf persisted to a local sqlite file, which survives restarts.
+
+    The shelf is stored at `path`, without any network dependency. Values
+    must be JSON-serializable. When the shelf has more than `maxsize` keys,
+    the least recently written keys are evicted. Eviction is checked after
+    every ``maxsize / 10`` writes, so the shelf can hold up to 10% more than
+    `maxsize` keys in between.
+
+    Each thread which uses the shelf has its own connection to the file, as
+    sqlite connections are not to be shared across threads.
+    """
+
+    def __init__(self, path='shelf.db', maxsize=100000):
+        self.path = path
+        self.maxsize = int(maxsize)
+        self.evict_every = max(1, self.maxsize // 10)
+        self.writes = 0
+        self.local = threading.local()
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS shelf '
+            '(key TEXT PRIMARY KEY, value TEXT)')
+
+    @property
+    def db(self):
+        """Get connection of the calling thread, connecting if needed."""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # Autocommit, with explicit transactions for batch writes.
+            db = sqlite3.connect(self.path, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def getitem(self, key):
+        row = self.db.execute(
+            'SELECT value FROM shelf WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def getitems(self, keys):
+        keys = list(keys)
+        result = {}
+        # Stay well within sqlite's limit on number of query parameters.
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.db.execute(
+                'SELECT key, value FROM shelf WHERE key IN ({})'
+                .format(','.join('?' * len(chunk))),
+                chunk)
+            for key, value in rows:
+                result[key] = json.loads(value)
+        return result
+
+    def setitem(self, key, value):
+        self.setitems([(key, value)])
+
+    def setitems(self, items):
+        rows = [(key, json.dumps(value)) for key, value in items]
+        self.db.execute('BEGIN')
+        try:
+            # Replacing a row gives it a new rowid, i.e. rowid is write order.
+            self.db.executemany(
+                'INSERT OR REPLACE INTO shelf (key, value) VALUES (?, ?)',
+                rows)
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+        self.writes += len(rows)
+        if self.writes >= self.evict_every:
+            self.evict()
+
+    def delitem(self, key):
+        cursor = self.db.execute('DELETE FROM shelf WHERE key = ?', (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def clear(self):
+        self.db.execute('DELETE FROM shelf')
+
+    def evict(self):
+        """Evict least recently written keys in excess of `maxsize`."""
+        self.writes = 0
+        count = self.db.execute('SELECT COUNT(*) FROM shelf').fetchone()[0]
+        if count <= self.maxsize:
+            return
+        self.db.execute(
+            'DELETE FROM shelf WHERE rowid IN '
+            '(SELECT rowid FROM shelf ORDER BY rowid LIMIT ?)',
+            (count - self.maxsize,))
+        self.stats.count('evictions', count - self.maxsize)
+
+    def __keytransform__(self, key):
+        # Use text keys, as sqlite returns them, to match keys in `getitems`.
+        if isinstance(key, str):
+            return key.decode('utf-8')
+        return unicode(key)
+
+
+class FreshSQLiteShelf(FreshPacker, SQLiteShelf):
+    """A sqlite file shelf which expires values."""
+
+
 class ElasticsearchShelf(Shelf):
-    """A shelf implemented using an elasticsearch index."""
+    """A shelf implemented using an elasticsearch index.
+
+    By default, every write is indexed immediately and refreshes the index. In
+    write-behind mode (`write_behind` true), writes are instead buffered in
+    memory and indexed with a single ``_bulk`` request and refresh, once
+    `flush_size` writes are pending or the oldest pending write is
+    `flush_age` seconds old, as checked on each access and on
+    :meth:`maintain`, which bolts call on tick tuples. Pending writes are
+    served on reads from this shelf only.
+
+    Write-behind is best effort: pending writes are lost if the process
+    dies, and are not yet seen by other processes sharing the index, so keep
+    `flush_size` and `flush_age` small. A flush is also attempted at
+    interpreter exit, which does not run if the process is killed.
+    """
 
-    def __init__(self, index='shelf', doc_type='shelf', **elasticsearch_init):
+    def __init__(self, index='shelf', doc_type='shelf', write_behind=False,
+                 flush_size=20, flush_age=1, **elasticsearch_init):
         self.es = elasticsearch.Elasticsearch(**elasticsearch_init)
         self.index_client = elasticsearch.client.IndicesClient(self.es)
         self.index = index
         self.doc_type = doc_type
 
+        self.write_behind = write_behind
+        self.flush_size = int(flush_size)
+        self.flush_age = flush_age
+        self.pending = collections.OrderedDict()
+        self.pending_since = None
+        if write_behind:
+            atexit.register(self.flush)
+
     def getitem(self, key):
+        self.flush_if_due()
+        if key in self.pending:
+            return self.pending[key]
+
         try:
             doc = self.es.get(index=self.index, doc_type=self.doc_type, id=key)
         except elasticsearch.exceptions.NotFoundError:
@@ -171,20 +1037,523 @@ class ElasticsearchShelf(Shelf):
 
         return value
 
+    def getitems(self, keys):
+        """Get values of all `keys` found in the index with one ``_mget``.
+
+        Elasticsearch returns document IDs as text, which are mapped back to
+        the requested keys:
+
+        >>> class FakeElasticsearch(object):
+        ...     def mget(self, body, doc_type):
+        ...         return {'docs': [
+        ...             {'_id': key_text(doc['_id']), 'found': True,
+        ...              '_source': {'value': 'v'}}
+        ...             for doc in body['docs']]}
+        >>> shelf = ElasticsearchShelf()
+        >>> shelf.es = FakeElasticsearch()
+        >>> shelf.get_many([123])
+        {123: 'v'}
+        >>>
+        """
+        self.flush_if_due()
+        result = {}
+        remote_keys = {}
+        for key in keys:
+            if key in self.pending:
+                result[key] = self.pending[key]
+            else:
+                remote_keys[key_text(key)] = key
+        if not remote_keys:
+            return result
+        docs = [
+            {'_index': index, '_id': key}
+            for index in self.read_indices()
+            for key in remote_keys.values()]
+        try:
+            response = self.es.mget(
+                body={'docs': docs}, doc_type=self.doc_type)
+        except elasticsearch.exceptions.NotFoundError:
+            return result
+
+        # Docs are in order of `read_indices`, such that later docs win.
+        for doc in response['docs']:
+            if not doc.get('found'):
+                continue
+            key = remote_keys.get(doc['_id'])
+            if key is None:
+                continue
+            try:
+                result[key] = doc['_source']['value']
+            except KeyError:
+                # Skip malformed data, as ``getitem`` would for a single key.
+                continue
+        return result
+
     def setitem(self, key, value):
+        if self.write_behind:
+            self.buffer([(key, value)])
+            return
         self.es.index(
-            index=self.index,
+            index=self.write_index(),
             doc_type=self.doc_type,
             id=key,
             body={'value': value},
             refresh=True)
 
+    def setitems(self, items):
+        """Set all (key, value) pairs in `items` with one ``_bulk`` request."""
+        if self.write_behind:
+            self.buffer(items)
+        else:
+            self.bulk_index(items)
+
     def delitem(self, key):
-        self.es.delete(index=self.index, doc_type=self.doc_type, id=key)
+        was_pending = self.pending.pop(key, UNSET) is not UNSET
+        try:
+            self.es.delete(index=self.index, doc_type=self.doc_type, id=key)
+        except elasticsearch.exceptions.NotFoundError:
+            if not was_pending:
+                raise
 
     def clear(self):
+        self.pending.clear()
+        self.pending_since = None
         self.index_client.delete(self.index)
 
+    def write_index(self):
+        """Get the name of the index to which to write."""
+        return self.index
+
+    def read_indices(self):
+        """Get names of indices from which to read, from oldest to newest."""
+        return [self.index]
+
+    def buffer(self, items):
+        """Add (key, value) pairs to pending writes, flushing if due."""
+        for key, value in items:
+            # Move key to the end, as to index most recent writes last.
+            self.pending.pop(key, None)
+            self.pending[key] = value
+        if self.pending_since is None and self.pending:
+            self.pending_since = time.time()
+        self.flush_if_due()
+
+    def maintain(self):
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush pending writes if there are enough or they are old enough."""
+        if not self.pending:
+            return
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+        elif time.time() - self.pending_since >= self.flush_age:
+            self.flush()
+
+    def flush(self):
+        """Index all pending writes with one ``_bulk`` request."""
+        if not self.pending:
+            return
+        start = time.time() if self.timed else None
+        self.bulk_index(self.pending.items())
+        if start is not None:
+            self.stats.observe('flush', start)
+        self.pending.clear()
+        self.pending_since = None
+
+    def bulk_index(self, items):
+        """Index (key, value) pairs with one ``_bulk`` request and refresh."""
+        items = list(items)
+        if not items:
+            return
+        response = self.es.bulk(
+            self.generate_bulk_body(items),
+            index=self.write_index(),
+            doc_type=self.doc_type,
+            refresh=True)
+        if response.get('errors'):
+            errors = [
+                item['index'] for item in response['items']
+                if 'error' in item['index']]
+            raise elasticsearch.helpers.BulkIndexError(
+                '{} document(s) failed to index.'.format(len(errors)), errors)
+
+    @staticmethod
+    def generate_bulk_body(items):
+        for key, value in items:
+            yield {'index': {'_id': key}}
+            yield {'value': value}
+
 
 class FreshElasticsearchShelf(FreshPacker, ElasticsearchShelf):
     """An shelf implementation with elasticsearch which expires values."""
+
+
+class RotatingElasticsearchShelf(FreshElasticsearchShelf):
+    """An elasticsearch shelf which expires values by rotating indices.
+
+    Values are written to time-bucketed indices named ``{index}-{bucket}``,
+    with one bucket per expiration window, and are read across the buckets
+    which can still hold fresh values. Whenever writes move on to a new
+    bucket, indices of buckets which can only hold stale values are deleted,
+    as to bound the size of the shelf instead of accumulating stale docs.
+    """
+
+    def __init__(self, *a, **kw):
+        super(RotatingElasticsearchShelf, self).__init__(*a, **kw)
+        self.current_bucket = None
+
+    def bucket(self, timestamp):
+        """Get the bucket number of the expiration window of `timestamp`."""
+        if self.expire_after is None:
+            raise ValueError('Rotating shelf requires a shelf_expiration.')
+        return int(timestamp // self.expire_after)
+
+    def bucket_index(self, bucket):
+        return '{}-{}'.format(self.index, bucket)
+
+    def live_buckets(self):
+        """Get buckets which can hold fresh values, from oldest to newest."""
+        now = self.freshness()
+        oldest = self.bucket(now - self.expire_after)
+        return range(oldest, self.bucket(now) + 1)
+
+    def write_index(self):
+        bucket = self.bucket(self.freshness())
+        if bucket != self.current_bucket:
+            self.current_bucket = bucket
+            self.drop_expired()
+        return self.bucket_index(bucket)
+
+    def read_indices(self):
+        return [self.bucket_index(bucket) for bucket in self.live_buckets()]
+
+    def drop_expired(self):
+        """Delete indices of all buckets older than the live buckets."""
+        oldest_live = self.live_buckets()[0]
+        prefix = self.index + '-'
+        try:
+            indices = self.index_client.get_settings(index=prefix + '*')
+        except elasticsearch.exceptions.NotFoundError:
+            return
+        for name in indices:
+            try:
+                bucket = int(name[len(prefix):])
+            except ValueError:
+                # Not an index of this shelf, e.g. a `shelf-other` index.
+                continue
+            if bucket < oldest_live:
+                self.index_client.delete(name)
+
+    def getitem(self, key):
+        value = self.getitems([key]).get(key, UNSET)
+        if value is UNSET:
+            raise KeyError(key)
+        return value
+
+    def delitem(self, key):
+        was_pending = self.pending.pop(key, UNSET) is not UNSET
+        deleted = False
+        for index in self.read_indices():
+            try:
+                self.es.delete(index=index, doc_type=self.doc_type, id=key)
+            except elasticsearch.exceptions.NotFoundError:
+                continue
+            deleted = True
+        if not (deleted or was_pending):
+            raise KeyError(key)
+
+    def clear(self):
+        self.pending.clear()
+        self.pending_since = None
+        self.current_bucket = None
+        self.index_client.delete(self.index + '-*')
+
+
+class TieredShelf(Shelf):
+    """A shelf with an in-memory LRU tier in front of any backing shelf.
+
+    Reads are served from the LRU tier when possible, otherwise they read
+    through to the backing shelf. Writes go through to both tiers. Keys found
+    missing on the backing shelf are remembered for `miss_expiration` seconds
+    as to not repeat lookups of recent misses; writing a key on this shelf
+    forgets that it was missing.
+
+    The backing shelf is configured with its own `shelf_class` and
+    `shelf_init`, nested in the ``shelf_init`` config of this shelf::
+
+        ResultTopicBolt:
+          shelf_class: TieredShelf
+          shelf_init:
+            maxsize: 10000
+            shelf_class: FreshElasticsearchShelf
+            shelf_init: {}
+          shelf_expiration: 3600
+
+    Packing is delegated to the backing shelf. The LRU tier holds packed
+    values, such that freshness (e.g. from `FreshPacker`) is checked just as
+    the backing shelf would check it.
+    """
+
+    def __init__(self, shelf_class='ElasticsearchShelf', shelf_init=None,
+                 maxsize=1000, miss_maxsize=1000, miss_expiration=5,
+                 **default_init):
+        self.backing = shelf_from_config(
+            {'shelf_class': shelf_class, 'shelf_init': shelf_init or {}},
+            **default_init)
+        self.store = LRUCache(int(maxsize))
+        self.misses = ExpiringLRUCache(int(miss_maxsize), miss_expiration)
+
+    def set_expiration(self, expire_after):
+        """Set expiration on the backing shelf, if it supports expiration."""
+        if hasattr(self.backing, 'set_expiration'):
+            self.backing.set_expiration(expire_after)
+
+    def is_valid(self, key, value):
+        """Return True if backing shelf would unpack `value`, else False."""
+        try:
+            self.backing.unpack(key, value)
+        except KeyError:
+            return False
+        return True
+
+    def getitem(self, key):
+        value = self.store.get(key, UNSET)
+        if value is not UNSET and self.is_valid(key, value):
+            self.stats.count('cache_hits')
+            return value
+        if self.misses.get(key) is not None:
+            self.stats.count('cache_misses')
+            raise KeyError(key)
+        self.stats.count('backing_reads')
+        try:
+            value = self.backing.getitem(key)
+        except KeyError:
+            self.misses.put(key, True)
+            raise
+        self.cache(key, value)
+        return value
+
+    def getitems(self, keys):
+        result = {}
+        remote_keys = []
+        for key in keys:
+            value = self.store.get(key, UNSET)
+            if value is not UNSET and self.is_valid(key, value):
+                result[key] = value
+                self.stats.count('cache_hits')
+            elif self.misses.get(key) is None:
+                remote_keys.append(key)
+            else:
+                self.stats.count('cache_misses')
+        if not remote_keys:
+            return result
+        self.stats.count('backing_reads', len(remote_keys))
+        found = self.backing.getitems(remote_keys)
+        for key in remote_keys:
+            if key in found:
+                result[key] = found[key]
+                self.cache(key, found[key])
+            else:
+                self.misses.put(key, True)
+        return result
+
+    def cache(self, key, value):
+        """Cache a packed value read from the backing shelf."""
+        if self.is_valid(key, value):
+            self.store.put(key, value)
+        else:
+            # Backing shelf has only an invalid (e.g. stale) value.
+            self.store.invalidate(key)
+            self.misses.put(key, True)
+
+    def setitem(self, key, value):
+        self.backing.setitem(key, value)
+        self.store.put(key, value)
+        self.misses.invalidate(key)
+
+    def setitems(self, items):
+        items = list(items)
+        self.backing.setitems(items)
+        for key, value in items:
+            self.store.put(key, value)
+            self.misses.invalidate(key)
+
+    def delitem(self, key):
+        self.store.invalidate(key)
+        self.misses.invalidate(key)
+        self.backing.delitem(key)
+
+    def clear(self):
+        self.store.clear()
+        self.misses.clear()
+        self.backing.clear()
+
+    def set_timed(self, timed=True):
+        super(TieredShelf, self).set_timed(timed)
+        self.backing.set_timed(timed)
+
+    def flush(self):
+        self.backing.flush()
+
+    def maintain(self):
+        self.backing.maintain()
+
+    def stats_snapshot(self):
+        snapshot = super(TieredShelf, self).stats_snapshot()
+        snapshot['counts']['evictions'] = self.store.evictions
+        snapshot['backing'] = self.backing.stats_snapshot()
+        return snapshot
+
+    def unpack(self, key, value):
+        return self.backing.unpack(key, value)
+
+    def pack(self, key, value):
+        return self.backing.pack(key, value)
+
+    def __keytransform__(self, key):
+        return self.backing.__keytransform__(key)
+
+
+class ShardedShelf(Shelf):
+    """A shelf which partitions keys across many backing shelves.
+
+    Each shard is configured with its own `shelf_class` and `shelf_init`, in
+    the ``shards`` list of this shelf's ``shelf_init`` config::
+
+        ResultTopicBolt:
+          shelf_class: ShardedShelf
+          shelf_init:
+            shards:
+            - shelf_class: ElasticsearchShelf
+              shelf_init: {hosts: [{host: es1}]}
+            - shelf_class: ElasticsearchShelf
+              shelf_init: {hosts: [{host: es2}]}
+
+    Keys are assigned to shards with consistent hashing, using `replicas`
+    points per shard on a hash ring, such that adding a shard moves only the
+    keys which the new shard takes over. A shard's points are based on its
+    optional ``name`` config, its position in the list by default, so add
+    shards to the end of the list (or name them) to keep keys in place.
+
+    Batch operations, and operations on all shards, run on each shard
+    concurrently in a thread pool.
+    """
+
+    def __init__(self, shards=(), replicas=100, **default_init):
+        if not shards:
+            raise ValueError('ShardedShelf requires at least one shard.')
+        self.shards = []
+        points = []
+        for i, shard_config in enumerate(shards):
+            self.shards.append(shelf_from_config(
+                {
+                    'shelf_class': shard_config['shelf_class'],
+                    'shelf_init': shard_config.get('shelf_init', {}),
+                },
+                **default_init))
+            name = shard_config.get('name', str(i))
+            for replica in range(int(replicas)):
+                point = self.hash('{} {}'.format(name, replica))
+                points.append((point, i))
+        points.sort()
+        self.ring_points = [p for p, _ in points]
+        self.ring_shards = [i for _, i in points]
+        self.pool = ThreadPool(len(self.shards))
+
+    @staticmethod
+    def hash(key):
+        """Get the position of `key` on the hash ring."""
+        return struct.unpack('<Q', hashlib.md5(key_bytes(key)).digest()[:8])[0]
+
+    def shard_index(self, key):
+        """Get the index of the shard to which `key` is assigned."""
+        i = bisect.bisect(self.ring_points, self.hash(key))
+        return self.ring_shards[i % len(self.ring_shards)]
+
+    def shard(self, key):
+        """Get the shard to which `key` is assigned."""
+        return self.shards[self.shard_index(key)]
+
+    def map_shards(self, fn, jobs):
+        """Call ``fn(shard, arg)`` for (shard, arg) jobs, concurrently."""
+        jobs = list(jobs)
+        if len(jobs) == 1:
+            shard, arg = jobs[0]
+            return [fn(shard, arg)]
+        return self.pool.map(lambda job: fn(*job), jobs)
+
+    def group(self, keys):
+        """Get list of (shard, keys) with each shard's keys of `keys`."""
+        groups = collections.OrderedDict()
+        for key in keys:
+            groups.setdefault(self.shard_index(key), []).append(key)
+        return [(self.shards[i], group) for i, group in groups.items()]
+
+    def set_expiration(self, expire_after):
+        """Set expiration on each shard which supports expiration."""
+        for shard in self.shards:
+            if hasattr(shard, 'set_expiration'):
+                shard.set_expiration(expire_after)
+
+    def getitem(self, key):
+        shard = self.shard(key)
+        return shard.getitem(shard.__keytransform__(key))
+
+    def getitems(self, keys):
+        def shard_getitems(shard, keys):
+            key_map = dict((shard.__keytransform__(key), key) for key in keys)
+            found = shard.getitems(list(key_map))
+            return dict((key_map[key], value) for key, value in found.items())
+
+        result = {}
+        for found in self.map_shards(shard_getitems, self.group(keys)):
+            result.update(found)
+        return result
+
+    def setitem(self, key, value):
+        shard = self.shard(key)
+        shard.setitem(shard.__keytransform__(key), value)
+
+    def setitems(self, items):
+        def shard_setitems(shard, items):
+            shard.setitems(
+                [(shard.__keytransform__(key), value) for key, value in items])
+
+        items = dict(items)
+        jobs = [
+            (shard, [(key, items[key]) for key in group])
+            for shard, group in self.group(items)]
+        self.map_shards(shard_setitems, jobs)
+
+    def delitem(self, key):
+        shard = self.shard(key)
+        shard.delitem(shard.__keytransform__(key))
+
+    def clear(self):
+        self.map_shards(lambda shard, _: shard.clear(), self.all_shards())
+
+    def set_timed(self, timed=True):
+        super(ShardedShelf, self).set_timed(timed)
+        for shard in self.shards:
+            shard.set_timed(timed)
+
+    def flush(self):
+        self.map_shards(lambda shard, _: shard.flush(), self.all_shards())
+
+    def maintain(self):
+        self.map_shards(lambda shard, _: shard.maintain(), self.all_shards())
+
+    def all_shards(self):
+        return [(shard, None) for shard in self.shards]
+
+    def stats_snapshot(self):
+        snapshot = super(ShardedShelf, self).stats_snapshot()
+        snapshot['shards'] = [shard.stats_snapshot() for shard in self.shards]
+        return snapshot
+
+    def unpack(self, key, value):
+        return self.shard(key).unpack(key, value)
+
+    def pack(self, key, value):
+        return self.shard(key).pack(key, value)
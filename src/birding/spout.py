@@ -1,11 +1,15 @@
 """Storm Spout classes."""
 
+import collections
 import datetime
-import itertools
+import heapq
+import time
 
 from streamparse.spout import Spout
 
 from .config import get_config, import_name
+from .shelf import shelf_from_config
+from .terms import term_source_from_config
 
 
 def DispatchSpout(*a, **kw):
@@ -40,21 +44,331 @@ class TermMethods(object):
         """
         return tuple(tup_id.rsplit(' ', 1))
 
+    def prepare_terms(self, config=None):
+        """Prepare terms based on config: TermCycleSpout/terms.
+
+        With config TermCycleSpout/term_source_class, terms are instead from
+        that :class:`~birding.terms.TermSource`, and change as the source
+        changes, see :meth:`update_terms`. Spouts implement ``add_terms`` and
+        ``remove_terms`` to apply changes, keeping the state of other terms.
+        """
+        if config is None:
+            config = get_config()
+        spout_config = config['TermCycleSpout']
+        self.term_source = term_source_from_config(spout_config)
+        if self.term_source is None:
+            self.add_terms(spout_config['terms'])
+        else:
+            self.update_terms()
+
+    def update_terms(self):
+        """Add and remove terms as changed by the term source, if any."""
+        if self.term_source is None:
+            return
+        added, removed = self.term_source.changes()
+        if removed:
+            self.remove_terms(removed)
+        if added:
+            self.add_terms(added)
+
+    def prepare_fresh(self, config=None):
+        """Prepare to skip terms which the search bolt would skip as fresh.
+
+        With config TermCycleSpout/skip_fresh, a term is fresh for
+        TwitterSearchBolt/shelf_expiration seconds once emitted, as the search
+        bolt skips terms searched within that time.
+        """
+        if config is None:
+            config = get_config()
+        self.fresh_until = {}
+        self.fresh_expiration = None
+        if config['TermCycleSpout']['skip_fresh']:
+            self.fresh_expiration = (
+                config['TwitterSearchBolt']['shelf_expiration'])
+
+    def fresh_wait(self, term):
+        """Get seconds until `term` is no longer fresh, 0 if not fresh."""
+        until = self.fresh_until.get(term)
+        if until is None:
+            return 0.0
+        return max(0.0, until - time.time())
+
+    def set_fresh(self, term):
+        """Track `term` as fresh, once emitted, if skipping fresh terms."""
+        if self.fresh_expiration is not None:
+            self.fresh_until[term] = time.time() + self.fresh_expiration
+
 
 class TermCycleSpout(Spout, TermMethods):
+    #: Most seconds to sleep when there are no terms or all are fresh.
+    idle_sleep = 1.0
+
     def initialize(self, stormconf, context):
         """Initialization steps:
 
-        1. Prepare sequence of terms based on config: TermCycleSpout/terms.
+        1. Prepare to skip fresh terms, if configured, see
+           :meth:`~TermMethods.prepare_fresh`.
+        2. Prepare cycle of terms, see :meth:`~TermMethods.prepare_terms`.
         """
-        self.terms = get_config()['TermCycleSpout']['terms']
-        self.term_seq = itertools.cycle(self.terms)
+        config = get_config()
+        self.terms = set()
+        self.term_queue = collections.deque() # Cycle, with removed terms.
+        self.queued = set()
+        self.prepare_fresh(config)
+        self.prepare_terms(config)
 
     def next_tuple(self):
         """Next tuple steps:
 
-        1. Emit (term, timestamp) for next term in sequence w/current UTC time.
+        1. Update terms from term source, if configured.
+        2. Emit (term, timestamp) for next term in cycle w/current UTC time.
+
+        When skipping fresh terms, the next term which is not fresh is
+        emitted, and when all terms are fresh, the spout sleeps instead.
         """
-        term = next(self.term_seq)
+        self.update_terms()
+        term = self.next_term()
+        if term is None:
+            # No terms, or all terms are fresh.
+            waits = [self.fresh_wait(t) for t in self.terms]
+            time.sleep(min(waits + [self.idle_sleep]))
+            return
         timestamp = datetime.datetime.utcnow().isoformat()
         self.emit([term, timestamp], tup_id=self.pack_tup_id(term, timestamp))
+        self.set_fresh(term)
+
+    def next_term(self):
+        """Get next term in cycle which is not fresh, None if none."""
+        for _ in range(len(self.term_queue)):
+            term = self.term_queue.popleft()
+            if term not in self.terms:
+                self.queued.discard(term) # Removed.
+                continue
+            self.term_queue.append(term)
+            if not self.fresh_wait(term):
+                return term
+        return None
+
+    def add_terms(self, terms):
+        for term in terms:
+            self.terms.add(term)
+            if term not in self.queued:
+                self.queued.add(term)
+                self.term_queue.append(term)
+
+    def remove_terms(self, terms):
+        for term in terms:
+            self.terms.discard(term)
+            self.fresh_until.pop(term, None)
+
+    def fail(self, tup_id):
+        """Let a failed term be emitted again, even if fresh."""
+        term, _ = self.parse_tup_id(tup_id)
+        self.fresh_until.pop(term, None)
+
+
+class TermSchedule(object):
+    """Schedule polling of terms in proportion to how fast they get statuses.
+
+    Each term has an exponentially weighted moving average (EWMA) of its
+    velocity in new statuses per second, weighted by `smoothing`, as fed back
+    with :meth:`feedback`. A term is polled once it would have
+    `target_count` new statuses, but not more often than every `min_interval`
+    seconds nor less often than every `max_interval` seconds. Terms without
+    feedback yet are polled every `min_interval` seconds.
+
+    >>> now = [0.0]
+    >>> schedule = TermSchedule(10, 600, 20, clock=lambda: now[0])
+    >>> schedule.add('pypi')
+    >>> schedule.next_term(), schedule.next_term()
+    ('pypi', None)
+    >>> schedule.feedback('pypi', count=50, when=0)
+    >>> schedule.feedback('pypi', count=2, when=20)
+    >>> schedule.interval('pypi')
+    200.0
+    >>>
+    """
+
+    def __init__(self, min_interval, max_interval, target_count,
+                 smoothing=0.3, clock=time.time):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_count = target_count
+        self.smoothing = smoothing
+        self.clock = clock
+        self.velocity = {} # Term to EWMA of new statuses per second.
+        self.feedback_time = {} # Term to time of its latest feedback.
+        self.due = {} # Term to when it is due, unless in flight.
+        self.heap = [] # (due, term), including entries no longer due.
+
+    def __contains__(self, term):
+        return term in self.velocity
+
+    def __len__(self):
+        return len(self.velocity)
+
+    def add(self, term, when=None):
+        """Add `term` to poll at `when` UNIX time, default now."""
+        self.velocity.setdefault(term, None)
+        self.schedule(term, self.clock() if when is None else when)
+
+    def remove(self, term):
+        """Stop polling `term`."""
+        self.velocity.pop(term, None)
+        self.feedback_time.pop(term, None)
+        self.due.pop(term, None)
+
+    def schedule(self, term, when):
+        self.due[term] = when
+        heapq.heappush(self.heap, (when, term))
+
+    def reschedule(self, term):
+        """Schedule next poll of `term`, once its poll completes."""
+        if term in self.velocity:
+            self.schedule(term, self.clock() + self.interval(term))
+
+    def next_term(self):
+        """Get next term which is due, None if none, as now in flight."""
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            when, term = heapq.heappop(self.heap)
+            if self.due.get(term) == when:
+                del self.due[term]
+                return term
+        return None
+
+    def feedback(self, term, count, when):
+        """Update velocity of `term`, with `count` new statuses at `when`."""
+        if term not in self.velocity:
+            return
+        previous = self.feedback_time.get(term)
+        if previous is not None and when <= previous:
+            return # Feedback was already seen.
+        self.feedback_time[term] = when
+        if previous is None:
+            return # Velocity is known from the next feedback on.
+        sample = float(count) / (when - previous)
+        velocity = self.velocity[term]
+        if velocity is None:
+            self.velocity[term] = sample
+        else:
+            self.velocity[term] = (
+                self.smoothing * sample + (1 - self.smoothing) * velocity)
+
+    def interval(self, term):
+        """Get seconds between polls of `term`."""
+        velocity = self.velocity.get(term)
+        if velocity is None:
+            return self.min_interval
+        if velocity <= 0:
+            return self.max_interval
+        interval = self.target_count / velocity
+        return min(self.max_interval, max(self.min_interval, interval))
+
+
+class AdaptiveTermSpout(TermMethods, Spout):
+    """Spout to poll each term as often as the term gets new statuses.
+
+    See :class:`TermSchedule`. The search bolt feeds back the number of new
+    statuses for each term searched, on a shelf shared with the spout, which
+    the spout reads once the term's tuple is acked.
+
+    The default feedback shelf is a :class:`~birding.shelf.SQLiteShelf` file
+    at a relative path, which is only shared by tasks running on one host in
+    the same working directory. On a cluster, configure a shelf which all
+    hosts share, e.g. :class:`~birding.shelf.ElasticsearchShelf`. Without
+    feedback, terms are polled every ``min_interval`` seconds, and the spout
+    logs a warning once `missing_feedback_warning` acks in a row have none.
+    """
+
+    #: Search bolts record feedback on the shelf of
+    #: :func:`~birding.shelf.get_feedback_shelf`.
+    uses_feedback = True
+
+    #: Acks in a row without feedback, after which to log a warning.
+    missing_feedback_warning = 20
+
+    def initialize(self, stormconf, context):
+        """Initialization steps:
+
+        1. Prepare to schedule terms, based on config: AdaptiveTermSpout.
+        2. Prepare to read feedback of searches, see
+           :func:`~birding.shelf.get_feedback_shelf`.
+        3. Prepare to skip fresh terms, if configured, see
+           :meth:`~TermMethods.prepare_fresh`.
+        4. Schedule terms, see :meth:`~TermMethods.prepare_terms`.
+        """
+        config = get_config()
+        spout_config = config['AdaptiveTermSpout']
+        self.schedule = TermSchedule(
+            spout_config['min_interval'],
+            spout_config['max_interval'],
+            spout_config['target_count'],
+            smoothing=spout_config['smoothing'])
+        self.feedback_shelf = shelf_from_config(spout_config)
+        self.missing_feedback = 0
+        self.prepare_fresh(config)
+        self.prepare_terms(config)
+
+    def next_tuple(self):
+        """Next tuple steps:
+
+        1. Update terms from term source, if configured.
+        2. Emit (term, timestamp) for next term which is due, if any.
+
+        When skipping fresh terms, a fresh term which is due is instead
+        scheduled for when it is no longer fresh.
+        """
+        self.update_terms()
+        term = self.schedule.next_term()
+        if term is None:
+            return
+        wait = self.fresh_wait(term)
+        if wait:
+            self.schedule.add(term, time.time() + wait)
+            return
+        timestamp = datetime.datetime.utcnow().isoformat()
+        self.emit([term, timestamp], tup_id=self.pack_tup_id(term, timestamp))
+        self.set_fresh(term)
+
+    def add_terms(self, terms):
+        for term in terms:
+            if term not in self.schedule:
+                self.schedule.add(term)
+
+    def remove_terms(self, terms):
+        """Stop polling terms, including any in flight once acked."""
+        for term in terms:
+            self.schedule.remove(term)
+            self.fresh_until.pop(term, None)
+
+    def ack(self, tup_id):
+        """Update term's velocity from feedback, and schedule its next poll."""
+        term, _ = self.parse_tup_id(tup_id)
+        feedback = self.feedback_shelf.get(term)
+        if feedback is not None:
+            self.missing_feedback = 0
+            self.schedule.feedback(term, feedback['count'], feedback['time'])
+        else:
+            self.warn_missing_feedback()
+        self.schedule.reschedule(term)
+
+    def warn_missing_feedback(self):
+        """Count an ack without feedback, and warn if none arrives at all.
+
+        Feedback is missing when the search bolts do not share the feedback
+        shelf with the spout, e.g. with a local shelf on another host.
+        """
+        self.missing_feedback += 1
+        if self.missing_feedback == self.missing_feedback_warning:
+            self.log(
+                'no search feedback for the last {} acked terms; check that '
+                'search bolts share the AdaptiveTermSpout shelf'
+                .format(self.missing_feedback),
+                level='warn')
+
+    def fail(self, tup_id):
+        """Schedule term's next poll, even if fresh."""
+        term, _ = self.parse_tup_id(tup_id)
+        self.fresh_until.pop(term, None)
+        self.schedule.reschedule(term)
@@ -0,0 +1,225 @@
+"""Sources of search terms, which change while the topology runs."""
+
+import io
+import os
+import time
+from abc import ABCMeta, abstractmethod
+
+from .config import import_name
+
+
+def term_source_from_config(config):
+    """Get a `TermSource` instance based on config, or None if not configured.
+
+    `config` is a dictionary containing ``term_source_class`` and
+    ``term_source_init`` keys as defined in :mod:`birding.config`.
+    """
+    if config.get('term_source_class') is None:
+        return None
+    source_cls = import_name(
+        config['term_source_class'], default_ns='birding.terms')
+    return source_cls(**config['term_source_init'])
+
+
+def parse_term_line(line):
+    """Parse a line of a term source into (add, term), or None if no term.
+
+    A line with a term adds that term, and a line with ``-`` and a term
+    removes that term. Use ``+`` to add a term which starts with ``-`` or
+    ``+``. Blank lines and lines starting with ``#`` are ignored.
+
+    >>> parse_term_line('apache storm'), parse_term_line('-pypi')
+    ((True, 'apache storm'), (False, 'pypi'))
+    >>> parse_term_line('+-from:parsely')
+    (True, '-from:parsely')
+    >>>
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line[0] in '+-':
+        return line[0] == '+', line[1:].strip()
+    return True, line
+
+
+class TermSource(object):
+    """Abstract base class for a source of terms to search.
+
+    Spouts get the changes to the source's terms with :meth:`changes`, and
+    apply them to the terms they poll.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self):
+        self.terms = set()
+
+    @abstractmethod
+    def changes(self):
+        """Get (added, removed) sets of terms since last called.
+
+        The first call adds all terms. Calls must not block for long, as
+        spouts call this on each next tuple.
+        """
+
+    def apply(self, lines, reset=False):
+        """Apply term lines to `terms`, return (added, removed) sets.
+
+        With `reset`, the lines list all terms, instead of changes to terms.
+        """
+        terms = set() if reset else set(self.terms)
+        for line in lines:
+            parsed = parse_term_line(line)
+            if parsed is None:
+                continue
+            add, term = parsed
+            if add:
+                terms.add(term)
+            else:
+                terms.discard(term)
+        added, removed = terms - self.terms, self.terms - terms
+        self.terms = terms
+        return added, removed
+
+
+class TermFile(TermSource):
+    r"""Terms in a file, one per line, checked every `poll_interval` seconds.
+
+    Lines are as in :func:`parse_term_line`. Lines appended to the file are
+    read as they are added, without reading the file again, which suits a
+    large list of terms with changes appended as ``term`` or ``-term`` lines.
+    When the file is otherwise changed, e.g. replaced or edited, the whole
+    file is read again and compared to the terms read before. A missing file
+    has no changes.
+
+    A last line without a newline is a term when the whole file is read, and
+    otherwise once it is unchanged since the previous check, as it may still
+    be being appended.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'terms.txt')
+    >>> def write(data, mode='wb'):
+    ...     with io.open(path, mode) as fd:
+    ...         _ = fd.write(data)
+    ...
+    >>> terms = TermFile(path, poll_interval=0)
+    >>> write(b'pypi\napache storm')
+    >>> sorted(terms.changes()[0])
+    [u'apache storm', u'pypi']
+    >>> write(b'single')
+    >>> [sorted(changed) for changed in terms.changes()]
+    [[u'single'], [u'apache storm', u'pypi']]
+    >>> write(b'\nkafka\nnew', mode='ab')
+    >>> [sorted(changed) for changed in terms.changes()]
+    [[u'kafka'], []]
+    >>> [sorted(changed) for changed in terms.changes()]
+    [[u'new'], []]
+    >>>
+    """
+
+    #: Bytes before the read offset compared to tell if the file is changed.
+    signature_size = 256
+
+    def __init__(self, path, poll_interval=5, clock=time.time):
+        super(TermFile, self).__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.polled = None
+        self.inode = None
+        self.offset = 0 # End of the last complete line read.
+        self.signature = b''
+        self.tail = b'' # Last line without a newline, as of last check.
+        self.tail_read = False # Whether `tail` was read as a term.
+
+    def changes(self):
+        now = self.clock()
+        if self.polled is not None and now - self.polled < self.poll_interval:
+            return set(), set()
+        self.polled = now
+        try:
+            fd = io.open(self.path, 'rb')
+        except (IOError, OSError):
+            return set(), set()
+        with fd:
+            data, reset = self.read(fd)
+            end = data.rfind(b'\n') + 1
+            complete, tail = data[:end], data[end:]
+            self.offset += len(complete)
+            self.signature = self.read_signature(fd)
+        lines = complete.decode('utf-8').splitlines()
+        tail_read = False
+        if tail and (reset or tail == self.tail):
+            try:
+                lines.append(tail.decode('utf-8'))
+                tail_read = True
+            except UnicodeDecodeError:
+                pass # Not yet complete.
+        self.tail, self.tail_read = tail, tail_read
+        if not lines and not reset:
+            return set(), set()
+        return self.apply(lines, reset=reset)
+
+    def read(self, fd):
+        """Read file from the last complete line, or all of it if changed.
+
+        Return (data, reset), with `reset` True if the whole file is read.
+        """
+        inode = os.fstat(fd.fileno()).st_ino
+        if inode == self.inode and self.is_unchanged(fd):
+            fd.seek(self.offset)
+            data = fd.read()
+            if not self.tail_read:
+                return data, False
+            if data == self.tail or data.startswith(self.tail + b'\n'):
+                return data, False
+            # A last line which was read as a term has changed.
+        self.inode = inode
+        self.offset = 0
+        fd.seek(0)
+        return fd.read(), True
+
+    def is_unchanged(self, fd):
+        """Check that the file is the same up to the read offset."""
+        if os.fstat(fd.fileno()).st_size < self.offset:
+            return False
+        return self.read_signature(fd) == self.signature
+
+    def read_signature(self, fd):
+        start = max(0, self.offset - self.signature_size)
+        fd.seek(start)
+        return fd.read(self.offset - start)
+
+
+class TermTopic(TermSource):
+    """Terms added and removed by messages on a Kafka topic.
+
+    Each message is a line as in :func:`parse_term_line`. The topic is read
+    from its earliest offset, to replay all changes since the topic began,
+    then each call of :meth:`changes` reads up to `max_messages` new
+    messages without blocking. Order of messages is only defined within a
+    partition, so use a topic with one partition, or partition messages by
+    term, if a term is added and removed in turn.
+    """
+
+    def __init__(self, topic, kafka_class='pykafka.KafkaClient',
+                 kafka_init=None, max_messages=10000):
+        super(TermTopic, self).__init__()
+        from pykafka.common import OffsetType
+        kafka_class = import_name(kafka_class)
+        self.client = kafka_class(**(kafka_init or {}))
+        self.consumer = self.client.topics[topic].get_simple_consumer(
+            auto_offset_reset=OffsetType.EARLIEST,
+            reset_offset_on_start=True)
+        self.max_messages = max_messages
+
+    def changes(self):
+        lines = []
+        while len(lines) < self.max_messages:
+            message = self.consumer.consume(block=False)
+            if message is None:
+                break
+            lines.append(message.value.decode('utf-8'))
+        if not lines:
+            return set(), set()
+        return self.apply(lines)
@@ -2,19 +2,117 @@
 
 from __future__ import absolute_import
 
+import functools
+import io
 import os
 import textwrap
+import threading
+from email.utils import mktime_tz, parsedate_tz
 
-from twitter.api import Twitter as BaseTwitter
+try:
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import HTTPError
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from twitter.api import Twitter as BaseTwitter, TwitterCall as BaseTwitterCall
+from twitter.api import TwitterHTTPError, wrap_response
 from twitter.cmdline import CONSUMER_KEY, CONSUMER_SECRET
 from twitter.oauth import OAuth, read_token_file
 
-from .search import SearchManager
+from .ratelimit import RateScheduler
+from .search import SearchManager, iter_limited
+from .shelf import shelf_from_config
+
+
+class TwitterCall(BaseTwitterCall):
+    """Twitter API call which sends its request over a requests `session`.
+
+    The session keeps connections alive across calls and accepts
+    gzip-compressed responses. Requests are signed as in the `twitter`
+    library. Without a session, calls use the `twitter` library's urllib
+    requests.
+    """
+
+    session = None
+
+    def __getattr__(self, k):
+        call = BaseTwitterCall.__getattr__(self, k)
+        if k == '_':
+            return lambda arg: self.share_session(call(arg))
+        return self.share_session(call)
+
+    def share_session(self, call):
+        call.session = self.session
+        return call
+
+    def _handle_response(self, req, uri, arg_data, _timeout=None):
+        if self.session is None:
+            return BaseTwitterCall._handle_response(
+                self, req, uri, arg_data, _timeout)
+        timeout = _timeout or self.timeout
+        if isinstance(timeout, list):
+            timeout = tuple(timeout) # (connect, read) from config.
+        response = self.session.request(
+            req.get_method(),
+            req.get_full_url(),
+            data=req.data,
+            headers=dict(req.header_items()),
+            timeout=timeout)
+        if response.status_code == 304:
+            return []
+        if response.status_code >= 400:
+            raise TwitterHTTPError(
+                self.http_error(response), uri, self.format, arg_data)
+        if not response.content:
+            return wrap_response({}, response.headers)
+        if self.format == 'json':
+            return wrap_response(response.json(), response.headers)
+        return wrap_response(response.text, response.headers)
+
+    @staticmethod
+    def http_error(response):
+        """Get urllib `HTTPError` of error response, for `TwitterHTTPError`."""
+        headers = CaseInsensitiveDict(response.headers)
+        # Content is already decompressed.
+        headers.pop('content-encoding', None)
+        return HTTPError(
+            response.url, response.status_code, response.reason, headers,
+            io.BytesIO(response.content))
+
+
+class Twitter(BaseTwitter, TwitterCall):
+    """Twitter API binding, see `twitter.api.Twitter`__.
+
+    Given a requests `session`, e.g. from :meth:`start_session`, API calls
+    are sent over that session with the given `timeout` in seconds, or
+    (connect, read) seconds. Given :class:`ThreadSessions` as `session`,
+    calls are sent over a session of the calling thread.
+
+    __ http://mike.verdone.ca/twitter/#api-documentation
+    """
 
+    def __init__(self, session=None, timeout=None, **kw):
+        BaseTwitter.__init__(self, **kw)
+        self.callable_cls = TwitterCall
+        self.sessions = session
+        self.timeout = timeout
+        self.gzip = True
+
+    @property
+    def session(self):
+        if isinstance(self.sessions, ThreadSessions):
+            return self.sessions.get()
+        return self.sessions
+
+    @staticmethod
+    def start_session():
+        """Get a requests session, which keeps its connections alive."""
+        return requests.Session()
 
-class Twitter(BaseTwitter):
     @classmethod
-    def from_oauth_file(cls, filepath=None):
+    def from_oauth_file(cls, filepath=None, **kw):
         """Get an object bound to the Twitter API using your own credentials.
 
         The `twitter` library ships with a `twitter` command that uses PIN
@@ -34,46 +132,351 @@ class Twitter(BaseTwitter):
 
         oauth_token, oauth_token_secret = read_token_file(filepath)
 
-        twitter = cls(
+        return cls.from_oauth(oauth_token, oauth_token_secret, **kw)
+
+    @classmethod
+    def from_oauth(cls, oauth_token, oauth_token_secret,
+                   consumer_key=CONSUMER_KEY, consumer_secret=CONSUMER_SECRET,
+                   **kw):
+        """Get an object bound to the Twitter API using given credentials.
+
+        The consumer defaults to that of the `twitter` command, as used to
+        create credential files for :meth:`from_oauth_file`. Keyword
+        arguments, e.g. `session`, are passed to :class:`Twitter`.
+        """
+        return cls(
             auth=OAuth(
-                oauth_token, oauth_token_secret, CONSUMER_KEY, CONSUMER_SECRET),
+                oauth_token, oauth_token_secret,
+                consumer_key, consumer_secret),
             api_version='1.1',
-            domain='api.twitter.com')
+            domain='api.twitter.com',
+            **kw)
+
+    @classmethod
+    def from_credentials(cls, credentials, **kw):
+        """Get an object from a credentials dict, as in birding config.
+
+        The dict has either a ``filepath`` key for :meth:`from_oauth_file` or
+        keyword arguments for :meth:`from_oauth`.
+        """
+        kw.update(credentials)
+        if 'filepath' in kw:
+            return cls.from_oauth_file(**kw)
+        return cls.from_oauth(**kw)
+
+
+class ThreadSessions(object):
+    """Keep-alive requests sessions, one for each thread which uses them.
+
+    Requests sessions are not thread-safe, so concurrent searches, e.g. of
+    :class:`~birding.bolt.TwitterSearchBolt` with ``concurrency``, each send
+    requests over a session of their own thread. As each thread sends one
+    request at a time, each session keeps one connection alive per host.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
 
-        return twitter
+    def get(self):
+        """Get session of the calling thread, starting it if needed."""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = Twitter.start_session()
+            self.local.session = session
+        return session
 
 
 class TwitterSearchManager(SearchManager):
-    """Service object to provide fully-hydrated tweets given a search query."""
+    """Service object to provide fully-hydrated tweets given a search query.
+
+    Given a `cursor_shelf` config, with ``shelf_*`` keys as in
+    :mod:`birding.config`, the manager tracks the highest status ID seen for
+    each query on that shelf, and then searches the query only for newer
+    statuses with ``since_id``. For example, in birding.yml::
+
+        SearchManager:
+          class: birding.twitter.TwitterSearchManagerFromOAuth
+          init:
+            cursor_shelf:
+              shelf_class: FreshLRUShelf
+              shelf_init: {maxsize: 10000}
+              shelf_expiration: 86400
+
+    The cursor advances as soon as a search returns, not once the search's
+    tuple is acked, as search bolts do not see acks downstream. So when a
+    tuple fails after the search, e.g. on indexing, its replay searches only
+    for statuses newer than those of the failed search, and those statuses
+    are not processed again. Without a `cursor_shelf`, every search returns
+    all recent statuses, and replays process them again.
+
+    Likewise, given a `status_shelf` config, the manager caches statuses on
+    that shelf when it looks them up, and looks up only statuses which are
+    not on the shelf. So :class:`~birding.bolt.TwitterLookupBolt` does not
+    look up statuses again which it recently looked up for other terms, and
+    still emits them in full, as tuples which first emitted them may fail
+    downstream and be replayed. For example, to cache 16MB of statuses, as
+    JSON, for 5 minutes::
+
+            status_shelf:
+              shelf_class: FreshSizedLRUShelf
+              shelf_init: {max_json_size: 16777216}
+              shelf_expiration: 300
+
+    Requests are paced within twitter's rate limits by a
+    :class:`~birding.ratelimit.RateScheduler`, starting from
+    `default_rate_limits` updated with any `rate_limits` given, then following
+    the limits twitter reports in each response. A request which would wait
+    longer than `max_wait` seconds raises
+    :class:`~birding.ratelimit.RateLimitError` instead, as to fail its tuple
+    rather than wait for a rate limit window of up to 15 minutes.
+
+    Given a list of `twitter` objects, each with its own credentials, the
+    manager pools their rate limits: each request goes to the credentials
+    with the most remaining budget for the endpoint. Credentials with no
+    remaining budget are not used until their rate limit window resets,
+    unless all credentials are exhausted. See
+    :func:`TwitterSearchManagerFromOAuth` to configure the pool.
+    """
+
+    #: Maximum number of status IDs in one `statuses/lookup` request.
+    lookup_max = 100
+
+    #: Maximum length of a `search/tweets` query, to coalesce terms.
+    max_query_length = 500
 
-    def __init__(self, twitter):
-        self.twitter = twitter
+    has_statuses = True
+
+    #: Nominal rate limits of endpoints, with user authentication.
+    default_rate_limits = {
+        'search/tweets': {'limit': 180, 'window': 15 * 60},
+        'statuses/lookup': {'limit': 180, 'window': 15 * 60},
+    }
+
+    def __init__(self, twitter, cursor_shelf=None, status_shelf=None,
+                 rate_limits=None, max_wait=10):
+        if not isinstance(twitter, (list, tuple)):
+            twitter = [twitter]
+        self.twitter = twitter[0]
+        self.cursors = self.shelf_from_init(cursor_shelf)
+        self.statuses = self.shelf_from_init(status_shelf)
+        self.shelf_lock = threading.Lock() # Shelves are not thread-safe.
+
+        limits = dict(self.default_rate_limits)
+        limits.update(rate_limits or {})
+        self.pool = [
+            (client, RateScheduler(limits, max_wait=max_wait))
+            for client in twitter]
+
+    @staticmethod
+    def shelf_from_init(config):
+        """Get shelf from config given to init, or None if not configured."""
+        if config is None:
+            return None
+        shelf_config = {'shelf_init': {}}
+        shelf_config.update(config)
+        return shelf_from_config(shelf_config)
 
     def search(self, q=None, **kw):
         """Search twitter for ``q``, return `results`__ directly from twitter.
 
+        When tracking cursors, ``since_id`` is set to the highest status ID
+        seen for ``q`` unless ``since_id`` or ``max_id`` is given. The cursor
+        advances on return, see :class:`TwitterSearchManager`.
+
         __ https://dev.twitter.com/rest/reference/get/search/tweets
         """
         if q is None:
             raise ValueError('No search query provided for `q` keyword.')
-        return self.twitter.search.tweets(q=q, **kw)
+        if self.cursors is None:
+            return self.search_tweets(q=q, **kw)
+        result = self.search_tweets(q=q, **self.cursor_params(q, kw))
+        self.update_cursor(q, result)
+        return result
+
+    def iter_search(self, q=None, max_pages=None, max_count=None,
+                    max_age=None, **kw):
+        """Search twitter for ``q``, lazily yielding statuses across pages.
+
+        Each next page is requested with ``max_id`` below the oldest status
+        of the previous page, once that page is consumed. See
+        :func:`~birding.search.iter_limited` for limits.
+        """
+        if q is None:
+            raise ValueError('No search query provided for `q` keyword.')
+        return iter_limited(
+            self.iter_search_pages(q, **kw),
+            status_time=self.status_time,
+            max_pages=max_pages,
+            max_count=max_count,
+            max_age=max_age)
+
+    def iter_search_pages(self, q, **kw):
+        """Search twitter for ``q``, lazily yielding lists of statuses."""
+        if self.cursors is not None:
+            kw = self.cursor_params(q, kw)
+        while True:
+            result = self.search_tweets(q=q, **kw)
+            if self.cursors is not None:
+                self.update_cursor(q, result)
+            statuses = result['statuses']
+            if not statuses:
+                return
+            yield statuses
+            kw['max_id'] = min(status['id'] for status in statuses) - 1
+
+    @staticmethod
+    def status_time(status):
+        """Get UNIX timestamp of when status was created."""
+        return mktime_tz(parsedate_tz(status['created_at']))
+
+    def cursor_params(self, q, kw):
+        """Get search params `kw` with ``since_id`` from cursor of ``q``."""
+        kw = dict(kw)
+        if 'since_id' not in kw and 'max_id' not in kw:
+            with self.shelf_lock:
+                since_id = self.cursors.get(q)
+            if since_id is not None:
+                kw['since_id'] = since_id
+        return kw
+
+    def update_cursor(self, q, result):
+        """Track the highest status ID in search `result` for ``q``."""
+        status_ids = [status['id'] for status in result['statuses']]
+        if not status_ids:
+            return
+        max_id = max(status_ids)
+        with self.shelf_lock:
+            since_id = self.cursors.get(q)
+            if since_id is None or max_id > since_id:
+                self.cursors[q] = max_id
+
+    def filter_result(self, result, match):
+        """Get copy of search `result` with only statuses whose text `match`.
+
+        Text includes the status text, the user's screen name and expanded
+        URLs, as twitter search matches these.
+        """
+        statuses = [
+            status for status in result['statuses']
+            if match(self.status_text(status))]
+        return dict(result, statuses=statuses)
+
+    @staticmethod
+    def status_text(status):
+        """Get text of status to match search terms."""
+        text = [status.get('full_text') or status['text']]
+        text.append(status['user']['screen_name'])
+        for url in status.get('entities', {}).get('urls', []):
+            text.append(url.get('expanded_url') or '')
+        return u'\n'.join(text)
 
     def lookup_search_result(self, result, **kw):
         """Perform :meth:`lookup` on return value of :meth:`search`."""
-        return self.lookup(s['id_str'] for s in result['statuses'], **kw)
+        return self.lookup(self.search_result_ids(result), **kw)
+
+    @staticmethod
+    def search_result_statuses(result):
+        """Get list of statuses in return value of :meth:`search`."""
+        return result['statuses']
+
+    @staticmethod
+    def search_result_ids(result):
+        """Get list of status ID strings in return value of :meth:`search`."""
+        return [s['id_str'] for s in result['statuses']]
 
     def lookup(self, id_list, **kw):
         """Lookup list of statuses, return `results`__ directly from twitter.
 
         Input can be any sequence of numeric or string values representing
-        twitter status IDs.
+        twitter status IDs. More than `lookup_max` IDs are looked up in
+        as many requests as needed.
+
+        When caching statuses, only statuses not in the cache are looked up,
+        and the result is in the order of the given IDs.
 
         __ https://dev.twitter.com/rest/reference/get/statuses/lookup
         """
-        result_id_pack = ','.join([str(_id) for _id in id_list])
-        if not result_id_pack:
-            return []
-        return self.twitter.statuses.lookup(_id=result_id_pack)
+        id_list = [str(_id) for _id in id_list]
+        if self.statuses is None:
+            return self.lookup_uncached(id_list)
+        with self.shelf_lock:
+            statuses = self.statuses.get_many(id_list)
+        looked_up = self.lookup_uncached(
+            [_id for _id in id_list if _id not in statuses])
+        with self.shelf_lock:
+            self.statuses.set_many(
+                (status['id_str'], status) for status in looked_up)
+        statuses.update((status['id_str'], status) for status in looked_up)
+        return [statuses[_id] for _id in id_list if _id in statuses]
+
+    def lookup_uncached(self, id_list):
+        """Lookup list of status ID strings, without the status cache."""
+        result = []
+        for i in range(0, len(id_list), self.lookup_max):
+            result_id_pack = ','.join(id_list[i:i + self.lookup_max])
+            result.extend(
+                self.request('statuses/lookup', _id=result_id_pack))
+        return result
+
+    def search_tweets(self, **kw):
+        """Request `search/tweets` with given parameters."""
+        return self.request('search/tweets', **kw)
+
+    def request(self, endpoint, **kw):
+        """Request API `endpoint`, e.g. ``search/tweets``, with params `kw`.
+
+        The request is made with the pooled credentials which have the most
+        remaining budget, and is paced within their rate limits.
+        """
+        twitter, scheduler = self.choose(endpoint)
+        call = functools.reduce(getattr, endpoint.split('/'), twitter)
+        scheduler.wait(endpoint)
+        try:
+            result = call(**kw)
+        except TwitterHTTPError as e:
+            scheduler.update(endpoint, e.e.headers, status=e.e.code)
+            raise
+        scheduler.update(endpoint, getattr(result, 'headers', None))
+        return result
+
+    def choose(self, endpoint):
+        """Get (twitter, scheduler) of pooled credentials for `endpoint`.
+
+        Choose credentials which can make a request soonest, i.e. which are
+        not exhausted, then those with the most remaining budget.
+        """
+        def rank(client):
+            _, scheduler = client
+            return (
+                scheduler.delay(endpoint),
+                -scheduler.remaining(endpoint))
+        return min(self.pool, key=rank)
+
+    def set_rate_limit_share(self, share):
+        """Pace requests of each credentials at ``1 / share`` of its limits."""
+        for _, scheduler in self.pool:
+            scheduler.set_share(share)
+
+    def rate_limit_stats(self):
+        """Get remaining rate limit budget and usage of each endpoint.
+
+        Stats are summed across pooled credentials, with the stats of each
+        credential in ``credentials``.
+        """
+        stats = {}
+        for _, scheduler in self.pool:
+            for endpoint, bucket_stats in scheduler.stats().items():
+                endpoint_stats = stats.setdefault(endpoint, {
+                    'remaining': 0,
+                    'requests': 0,
+                    'waited': 0.0,
+                    'credentials': [],
+                })
+                endpoint_stats['remaining'] += scheduler.remaining(endpoint)
+                endpoint_stats['requests'] += bucket_stats['requests']
+                endpoint_stats['waited'] += bucket_stats['waited']
+                endpoint_stats['credentials'].append(bucket_stats)
+        return stats
 
     @staticmethod
     def dump(result):
@@ -95,12 +498,40 @@ class TwitterSearchManager(SearchManager):
         return u'\n\n'.join(status_str_list)
 
 
-def TwitterSearchManagerFromOAuth(*a, **kw):
+def TwitterSearchManagerFromOAuth(filepath=None, credentials=None,
+                                  timeout=None, **kw):
     """Build :class:`TwitterSearchManager` from user OAuth file.
 
-    Arguments are passed to :meth:`birding.twitter.Twitter.from_oauth_file`.
+    `filepath` is passed to :meth:`birding.twitter.Twitter.from_oauth_file`,
+    and keyword arguments are passed to :class:`TwitterSearchManager`.
+
+    Given a list of `credentials`, build the manager with a pool of all of
+    them instead, see :meth:`birding.twitter.Twitter.from_credentials`. For
+    example, in birding.yml::
+
+        SearchManager:
+          class: birding.twitter.TwitterSearchManagerFromOAuth
+          init:
+            credentials:
+            - filepath: /etc/birding/twitter_oauth_1
+            - oauth_token: ...
+              oauth_token_secret: ...
+              consumer_key: ...
+              consumer_secret: ...
+
+    All credentials share keep-alive HTTP sessions, one for each thread,
+    with requests `timeout` in seconds or as [connect, read] seconds. See
+    :class:`birding.twitter.Twitter` and :class:`ThreadSessions`.
     """
-    return TwitterSearchManager(Twitter.from_oauth_file(*a, **kw))
+    http = {
+        'session': ThreadSessions(),
+        'timeout': timeout,
+    }
+    if credentials is None:
+        twitter = Twitter.from_oauth_file(filepath, **http)
+    else:
+        twitter = [Twitter.from_credentials(c, **http) for c in credentials]
+    return TwitterSearchManager(twitter, **kw)
 
 
 def main():
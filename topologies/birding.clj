@@ -21,6 +21,8 @@
           "birding.bolt.TwitterSearchBolt"
           ["term" "timestamp" "search_result"]
           :p 2
+          ; Tick to search batched terms, see TwitterSearchBolt config.
+          :conf {"topology.tick.tuple.freq.secs", 1}
           )
      "lookup-bolt" (python-bolt-spec
           options
@@ -28,6 +30,8 @@
           "birding.bolt.TwitterLookupBolt"
           ["term" "timestamp" "lookup_result"]
           :p 2
+          ; Tick to look up batched status IDs, see TwitterLookupBolt config.
+          :conf {"topology.tick.tuple.freq.secs", 1}
           )
      "elasticsearch-index-bolt" (python-bolt-spec
           options
@@ -42,6 +46,8 @@
           "birding.bolt.ResultTopicBolt"
           []
           :p 1
+          ; Tick to maintain tweet shelf, e.g. flush its buffered writes.
+          :conf {"topology.tick.tuple.freq.secs", 1}
           )
     }
   ]